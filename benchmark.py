@@ -0,0 +1,861 @@
+#!/usr/bin/python3.7
+"""
+Benchmarks of the simulator internals.
+
+Usage:
+    benchmark.py [name ...]
+
+Runs selected benchmarks, or all of them when no name is specified.
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import struct
+import statistics
+import threading
+import tempfile
+import importlib
+import socket
+import shutil
+import contextlib
+import subprocess
+import multiprocessing
+
+import token_codec
+import transport
+import shm_ring
+from simul import PNSim, Scheduler, HeapQueue, TimingWheel
+from mqtt_client import Mqtt_client, unpack_batch
+from sample_nets import boiler_logic
+from sample_nets.imports import PetriNet, Place
+from snakes.nets import dot, tFloat, tTuple, tBoolean, tBlackToken
+
+
+def bench_scheduler(rooms=2000, duration=300.0, tick=0.1):
+    """
+    Compares scheduler backends on the timed transitions of the rooms.
+
+    Every room re-arms two timers, with 5s timeout (heating) and 30s timeout
+    (outside exchange), started at random phase. All events due at the time
+    returned by next_planned are popped on a single wakeup, as the simulation
+    loop does.
+
+    rooms --    number of simulated rooms
+    duration -- simulated time in seconds
+    tick --     tick length of the timing wheel
+    """
+    print(f'Scheduler: {rooms} rooms, {duration}s of simulated time')
+    print(f'{"backend":<20}{"events":>10}{"wakeups":>10}{"time [s]":>10}{"events/s":>12}')
+    backends = [
+        ('heapq', HeapQueue),
+        (f'wheel tick={tick}s', lambda: TimingWheel(tick)),
+    ]
+    for name, backend in backends:
+        rnd = random.Random(42)
+        sched = Scheduler(backend())
+        sched.start(0.0)
+        for room in range(rooms):
+            for timeout in (5.0, 30.0):
+                sched.plan(rnd.random() * timeout, [room, timeout])
+        events = wakeups = 0
+        start = time.perf_counter()
+        tm = sched.next_planned()
+        while tm is not None and tm < duration:
+            wakeups += 1
+            while sched.next_planned() == tm:
+                _, (room, timeout) = sched.pop_planned()
+                sched.plan(tm + timeout, [room, timeout])
+                events += 1
+            tm = sched.next_planned()
+        elapsed = time.perf_counter() - start
+        print(f'{name:<20}{events:>10}{wakeups:>10}{elapsed:>10.3f}{events / elapsed:>12.0f}')
+
+
+def fire_until_blocked(net):
+    """
+    Fires transitions of the net in order of execute_groups until none
+    is enabled, returns count of firings.
+    """
+    firings = 0
+    groups = net.transition_groups()
+    while True:
+        fired = None
+        for group in groups:
+            for t in group:
+                if t.fire_first() is not None:
+                    fired = t
+                    break
+            if fired:
+                break
+        if fired is None:
+            return firings
+        firings += 1
+
+
+def bench_compiler(rooms=50, updates=200):
+    """
+    Compares interpreted and compiled firing on the boiler logic.
+
+    The table of the boiler is filled with states of the rooms, then random
+    state updates are processed one by one.
+
+    rooms --    number of rooms in the table
+    updates --  number of processed state updates
+    """
+    print(f'Compiled transitions: {rooms} rooms, {updates} updates')
+    print(f'{"mode":<20}{"firings":>10}{"time [s]":>10}{"firings/s":>12}')
+    for name, compiled in (('interpreted', False), ('compiled', True)):
+        rnd = random.Random(42)
+        net = boiler_logic('boiler')
+        net.compiled = compiled
+        net.prepare()
+        for room in range(rooms):
+            net.place('Sensory input').add([(f'room{room}', rnd.random() < 0.5)])
+        fire_until_blocked(net)
+        firings = 0
+        start = time.perf_counter()
+        for _ in range(updates):
+            room = rnd.randrange(rooms)
+            net.place('Sensory input').add([(f'room{room}', rnd.random() < 0.5)])
+            firings += fire_until_blocked(net)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<20}{firings:>10}{elapsed:>10.3f}{firings / elapsed:>12.0f}')
+
+
+def bench_joins(sizes=(10, 100, 10000), updates=100):
+    """
+    Compares enumeration of modes of the "Update state" transition of the boiler
+    logic, which joins sensory input with the table on the guard
+    name == existing_name.
+
+    The table is filled with states of the rooms, then random state updates
+    are processed one by one by the transition.
+
+    sizes --    numbers of entries in the table
+    updates --  number of processed state updates
+    """
+    print(f'Equality joins: {updates} updates')
+    print(f'{"mode":<20}{"entries":>10}{"time [s]":>10}{"updates/s":>12}')
+    modes = [
+        ('interpreted', False, False),
+        ('nested loops', True, False),
+        ('hash join', True, True),
+    ]
+    for size in sizes:
+        for name, compiled, joins in modes:
+            rnd = random.Random(42)
+            net = boiler_logic('boiler')
+            net.compiled = compiled
+            ustate = net.transition('Update state')
+            ustate.HASH_JOINS = joins
+            net.prepare()
+            net.place('Table').add([(f'room{room}', 'processed') for room in range(size)])
+            start = time.perf_counter()
+            for _ in range(updates):
+                room = rnd.randrange(size)
+                net.place('Sensory input').add([(f'room{room}', rnd.random() < 0.5)])
+                if ustate.fire_first() is None:
+                    raise Exception(f'Update of room{room} was not processed')
+            elapsed = time.perf_counter() - start
+            print(f'{name:<20}{size:>10}{elapsed:>10.3f}{updates / elapsed:>12.0f}')
+
+
+def bench_ordering(rooms=1000, active=10, updates=200):
+    """
+    Compares binding of input arcs in order of declaration and in order
+    planned by sizes of the places on the boiler logic.
+
+    The table is filled with states of the rooms and a few rooms are active,
+    then random state updates are processed by the whole net.
+
+    rooms --    number of rooms in the table
+    active --   number of active rooms
+    updates --  number of processed state updates
+    """
+    print(f'Arcs ordering: {rooms} rooms, {active} active, {updates} updates')
+    print(f'{"order":<20}{"examined":>12}{"produced":>10}{"time [s]":>10}')
+    for name, reorder in (('declaration', False), ('planned', True)):
+        rnd = random.Random(42)
+        net = boiler_logic('boiler')
+        for t in net.transition():
+            t.REORDER_ARCS = reorder
+        net.prepare()
+        net.place('Table').add([(f'room{room}', 'processed') for room in range(rooms)])
+        net.place('Active Table').add([f'room{room}' for room in range(active)])
+        start = time.perf_counter()
+        for _ in range(updates):
+            room = rnd.randrange(rooms)
+            net.place('Sensory input').add([(f'room{room}', rnd.random() < 0.5)])
+            fire_until_blocked(net)
+        elapsed = time.perf_counter() - start
+        examined, produced = net.binding_stats()
+        print(f'{name:<20}{examined:>12}{produced:>10}{elapsed:>10.3f}')
+
+
+def bench_codec(messages=20000):
+    """
+    Compares token formats on payloads typical for the ports of the nets.
+
+    messages -- number of encoded and decoded messages of each payload
+    """
+    payloads = [
+        ('temperature', [21.5], tFloat),
+        ('room state', [('dining_room', True)], tTuple),
+        ('boiler state', [False], tBoolean),
+        ('poll', [dot], tBlackToken),
+        ('100 temperatures', [20.0 + i / 10 for i in range(100)], tFloat),
+    ]
+    print(f'Token formats: {messages} messages')
+    print(f'{"payload":<20}{"format":<8}{"size [B]":>10}{"encode [us]":>14}{"decode [us]":>14}')
+    for name, tokens, check in payloads:
+        for fmt in (token_codec.TEXT, token_codec.BINARY):
+            payload = token_codec.encode(tokens, check, fmt)
+            if token_codec.decode(payload) != tokens:
+                raise Exception(f'Tokens {tokens} are not decoded back from {payload}')
+            start = time.perf_counter()
+            for _ in range(messages):
+                token_codec.encode(tokens, check, fmt)
+            encode = (time.perf_counter() - start) / messages * 1e6
+            start = time.perf_counter()
+            for _ in range(messages):
+                token_codec.decode(payload)
+            decode = (time.perf_counter() - start) / messages * 1e6
+            print(f'{name:<20}{fmt:<8}{len(payload):>10}{encode:>14.2f}{decode:>14.2f}')
+
+
+def timed(function):
+    """
+    Wraps the function to record durations of its calls in attribute times.
+    """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            wrapper.times.append(time.perf_counter() - start)
+    wrapper.times = []
+    return wrapper
+
+
+def bench_local(duration=2000.0):
+    """
+    Compares delivery of tokens between the nets of all-in-one.py through
+    the token format and direct delivery to the places of the local nets.
+
+    Time spent in send_tokens of the nets is measured separately, as the whole
+    run is dominated by the scheduling and firing of the transitions.
+    The nets are simulated in virtual time, connection to the broker
+    is required.
+
+    duration -- simulated time in seconds
+    """
+    aio = importlib.import_module('all-in-one')
+    print(f'Local delivery: all-in-one, {duration}s of simulated time')
+    print(f'{"delivery":<20}{"firings":>10}{"time [s]":>10}{"sends":>10}'
+          f'{"send [s]":>10}{"send [us]":>12}')
+    for name, local in (('encoded', False), ('direct', True)):
+        nets = aio.execute_boiler() + aio.execute_rooms() + aio.execute_surround()
+        sim = PNSim(simul_id=f'bench-local-{name}', debug=False, virtual=True)
+        sim.mqtt.LOCAL_DELIVERY = local
+        sends = {}
+        for net in nets:
+            sends[net.name] = timed(net.send_tokens)
+            net.send_tokens = sends[net.name]
+            net.add_simulator(sim)
+            sim.schedule_at([sim.execute_net, net.name], PNSim.NOW)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            sim.setup(duration)
+            start = time.perf_counter()
+            sim.start()
+            sim.join()
+            elapsed = time.perf_counter() - start
+        firings = out.getvalue().count('Firing:')
+        calls = sum(len(send.times) for send in sends.values())
+        send_time = sum(sum(send.times) for send in sends.values())
+        print(f'{name:<20}{firings:>10}{elapsed:>10.3f}{calls:>10}'
+              f'{send_time:>10.3f}{send_time / calls * 1e6:>12.1f}')
+
+
+def bench_routing(nets=10, ports=1000, messages=100000):
+    """
+    Compares subscriptions per input port and per net, and routing of
+    received messages by the table of ports and by names of net and place.
+
+    The input ports are spread evenly over the nets, connection to the
+    broker is required.
+
+    nets --     number of nets
+    ports --    number of input ports
+    messages -- number of routed messages
+    """
+    print(f'Routing: {nets} nets, {ports} input ports, {messages} messages')
+    print(f'{"subscriptions":<20}{"count":>10}{"routing":>10}{"time [us]":>12}')
+    for name, wildcard in (('per port', False), ('per net', True)):
+        sim = PNSim(simul_id=f'bench-routing-{name}', debug=False, virtual=True)
+        sim.mqtt.WILDCARD_SUBSCRIPTIONS = wildcard
+        topics = []
+        for n in range(nets):
+            net = PetriNet(f'routing-{n}')
+            for p in range(ports // nets):
+                place = Place(f'port-{p}', [], check=tFloat)
+                net.add_place(place)
+                net.add_remote_input(place, f'routing-source/port-{n}-{p}')
+                topics.append(f'{net.name}/{place.name}')
+            net.add_simulator(sim)
+        sim.setup()
+        rnd = random.Random(42)
+        received = [rnd.choice(topics) for _ in range(messages)]
+        if wildcard:
+            routing = 'table'
+            start = time.perf_counter()
+            for topic in received:
+                sim.mqtt.route(topic)
+        else:
+            routing = 'names'   # Lookup of the port before the routing table
+            start = time.perf_counter()
+            for topic in received:
+                net, place = topic.split('/')
+                if net in sim.mqtt.nets.keys():
+                    sim.mqtt.nets[net].place(place)
+        elapsed = (time.perf_counter() - start) / messages * 1e6
+        sim.mqtt.close()
+        print(f'{name:<20}{len(sim.mqtt.subscriptions):>10}{routing:>10}{elapsed:>12.3f}')
+
+
+def start_hbmqtt(directory):
+    """
+    Starts hbmqtt broker with configuration of hbmqtt.conf on a free local
+    port, returns its process and address.
+
+    directory -- directory of the configuration file
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hbmqtt.conf')
+    with open(source) as conf:
+        config = conf.read().replace('0.0.0.0:1883', f'127.0.0.1:{port}')
+    path = os.path.join(directory, f'hbmqtt-{port}.conf')
+    with open(path, 'w') as conf:
+        conf.write(config)
+    script = os.path.join(os.path.dirname(sys.executable), 'hbmqtt')   # Installed with the interpreter
+    command = [sys.executable, script] if os.path.exists(script) else [shutil.which('hbmqtt')]
+    broker = subprocess.Popen(
+        command + ['-c', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+            return broker, f'mqtt://127.0.0.1:{port}'
+        except OSError:
+            if broker.poll() is not None:
+                raise Exception(f'hbmqtt exited with code {broker.returncode}')
+            time.sleep(0.1)
+
+
+def bench_planes(connections=(0, 1, 2, 4), producers=4, messages=2000, ports=16, interval=0.05, broker=None):
+    """
+    Compares latency of control messages and throughput of port messages,
+    when port messages share the control connection and when they are sent
+    over separate data connections.
+
+    Producer threads flood the ports with tokens sent at least once, while
+    control messages are sent to the client itself over the control
+    connection. Measurement ends, when all port messages are received or
+    none is received for 10s. The nets are not simulated.
+
+    Every number of connections is measured on its own hbmqtt broker started
+    for it, as messages and subscriptions left in the broker by the previous
+    measurement slow it down. hbmqtt is required.
+
+    connections --  numbers of data connections, 0 shares the control connection
+    producers --    number of threads sending port messages
+    messages --     number of port messages sent by all producers
+    ports --        number of port topics
+    interval --     pause between control messages in seconds
+    broker --       address of the broker shared by all measurements instead
+    """
+    print(f'Control and data planes: {producers} producers, {messages} port messages, {ports} ports')
+    print(f'{"data connections":<20}{"time [s]":>10}{"received":>10}{"messages/s":>12}'
+          f'{"control":>10}{"median [ms]":>14}{"max [ms]":>10}')
+    payload = token_codec.encode([21.5], tFloat)
+    topics = [f'bench-planes/port-{p}' for p in range(ports)]
+    default = Mqtt_client.DATA_CONNECTIONS
+    directory = tempfile.mkdtemp()
+    for count in connections:
+        server, address = start_hbmqtt(directory) if broker is None else (None, broker)
+        Mqtt_client.DATA_CONNECTIONS = count
+        try:
+            sim = PNSim(broker=address, simul_id=f'bench-planes-{count}', debug=False, virtual=True)
+        finally:
+            Mqtt_client.DATA_CONNECTIONS = default
+        sim.setup()
+        mqtt = sim.mqtt
+        received = threading.Semaphore(0)
+        latencies = []
+        for client, _ in mqtt.data_clients[mqtt.broker] or [(mqtt.client, None)]:
+            client.message_callback_add('bench-planes/#', lambda *_: received.release())
+        ping = f'bench-planes-ping/{mqtt.session}'
+        mqtt.client.message_callback_add(
+            ping, lambda c, u, message: latencies.append(time.perf_counter() - float(message.payload)))
+        mqtt.client.subscribe(ping, 2)
+        for topic in topics:
+            mqtt.add_subscription(topic, 1)
+        time.sleep(1.0)     # Subscriptions are acknowledged
+
+        def produce(number):
+            for i in range(messages // producers):
+                mqtt.port_publish(topics[(number + i * producers) % ports], payload, 'at_least_once')
+
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        pings = 0
+        done = 0
+        progress = start
+        while done < messages // producers * producers and time.perf_counter() - progress < 10.0:
+            mqtt.publish(ping, str(time.perf_counter()), 2)
+            pings += 1
+            time.sleep(interval)
+            while received.acquire(blocking=False):
+                done += 1
+                progress = time.perf_counter()
+        elapsed = progress - start
+        for thread in threads:
+            thread.join()
+        time.sleep(0.5)     # Responses to the last control messages
+        mqtt.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        median = statistics.median(latencies) * 1e3 if latencies else float('nan')
+        worst = max(latencies) * 1e3 if latencies else float('nan')
+        print(f'{count:<20}{elapsed:>10.3f}{done:>10}{done / elapsed:>12.0f}'
+              f'{len(latencies):>4}/{pings:<5}{median:>14.2f}{worst:>10.2f}')
+    shutil.rmtree(directory)
+
+
+def bench_transports(rounds=500, messages=5000, broker='127.0.0.1'):
+    """
+    Compares latency and throughput of the transports between two clients.
+
+    Latency is measured by round trips of single messages, which are sent
+    back by the other client. Throughput by a stream of messages sent
+    at once by one client to the other, the measurement ends, when all are
+    received or none is received for 10s. Messages are sent with QoS 1,
+    as by the ports delivered at least once. Bus of the Unix socket
+    transport is served by another process, MQTT broker is required.
+
+    rounds --   number of round trips
+    messages -- number of streamed messages
+    broker --   address of the MQTT broker
+    """
+    print(f'Transports: {rounds} round trips, {messages} messages')
+    print(f'{"transport":<20}{"median [us]":>12}{"99% [us]":>12}{"received":>10}{"messages/s":>12}')
+    payload = token_codec.encode([21.5], tFloat)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.sock')
+    server = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transport.py'), path])
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        for name, address in (('mqtt', broker), ('local', 'local://bench'), ('unix', f'unix://{path}')):
+            pong = threading.Event()
+            received = threading.Semaphore(0)
+
+            def echo(client, userdata, message):
+                if message.topic == 'bench-transport/ping':
+                    client.publish('bench-transport/pong', message.payload, 1)
+                else:
+                    received.release()
+
+            clients = []
+            for on_message, topics in ((lambda *_: pong.set(), ['bench-transport/pong']),
+                                       (echo, ['bench-transport/ping', 'bench-transport/data'])):
+                client, args = transport.create_client(address)
+                client.on_message = on_message
+                client.connect(*args)
+                client.loop_start()
+                for topic in topics:
+                    client.subscribe(topic, 1)
+                clients.append((client, topics))
+            time.sleep(1.0)     # Subscriptions are acknowledged
+            sender = clients[0][0]
+            latencies = []
+            for _ in range(rounds):
+                pong.clear()
+                start = time.perf_counter()
+                sender.publish('bench-transport/ping', payload, 1)
+                if pong.wait(5.0):
+                    latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            start = time.perf_counter()
+            for _ in range(messages):
+                sender.publish('bench-transport/data', payload, 1)
+            done = 0
+            end = start
+            while done < messages and received.acquire(timeout=10.0):
+                done += 1
+                end = time.perf_counter()
+            for client, topics in clients:
+                client.unsubscribe(topics)
+                client.disconnect()
+                client.loop_stop()
+            median = latencies[len(latencies) // 2] * 1e6 if latencies else float('nan')
+            tail = latencies[len(latencies) * 99 // 100] * 1e6 if latencies else float('nan')
+            print(f'{name:<20}{median:>12.0f}{tail:>12.0f}{done:>10}{done / (end - start):>12.0f}')
+    finally:
+        server.terminate()
+        server.wait()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+def _ring_echo(name, pipe, messages):
+    """
+    Sends messages of the ring "ping" back to the ring received from the pipe,
+    counts messages of the ring "data" and reports, when all were received.
+    """
+    rings = {}
+    received = []
+
+    def handle(topic, payload):
+        if topic == 'ping':
+            rings['pong'].put(payload)
+        else:
+            received.append(None)
+            if len(received) == messages:
+                rings['pong'].put(b'done')
+
+    reader = shm_ring.RingReader(handle, name)
+    paths = (reader.create('ping'), reader.create('data'))
+    rings['pong'] = shm_ring.Ring.attach(pipe.recv())
+    pipe.send(paths)
+    pipe.recv()     # Measurement finished
+    rings['pong'].close()
+    reader.close()
+
+
+def bench_rings(rounds=5000, messages=100000):
+    """
+    Measures latency and throughput of shared memory rings between two
+    processes, in the same way as the transports are measured.
+
+    rounds --   number of round trips
+    messages -- number of streamed messages
+    """
+    print(f'Shared memory rings: {rounds} round trips, {messages} messages')
+    print(f'{"transport":<20}{"median [us]":>12}{"99% [us]":>12}{"received":>10}{"messages/s":>12}')
+    payload = token_codec.encode([21.5], tFloat)
+    pong = threading.Event()
+    done = threading.Event()
+
+    def handle(topic, payload):
+        (done if payload == b'done' else pong).set()
+
+    name = f'bench-rings-{os.getpid()}'
+    reader = shm_ring.RingReader(handle, name)
+    pipe, child = multiprocessing.Pipe()
+    echo = multiprocessing.Process(target=_ring_echo, args=(f'{name}-echo', child, messages))
+    echo.start()
+    try:
+        pipe.send(reader.create('pong'))
+        ping, data = [shm_ring.Ring.attach(path) for path in pipe.recv()]
+        latencies = []
+        for _ in range(rounds):
+            pong.clear()
+            start = time.perf_counter()
+            ping.put(payload)
+            if pong.wait(5.0):
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        start = time.perf_counter()
+        for _ in range(messages):
+            data.put(payload)
+        received = messages if done.wait(60.0) else 0
+        elapsed = time.perf_counter() - start
+        ping.close()
+        data.close()
+        median = latencies[len(latencies) // 2] * 1e6 if latencies else float('nan')
+        tail = latencies[len(latencies) * 99 // 100] * 1e6 if latencies else float('nan')
+        print(f'{"shm":<20}{median:>12.0f}{tail:>12.0f}{received:>10}{received / elapsed:>12.0f}')
+    finally:
+        pipe.send(None)
+        echo.join()
+        reader.close()
+
+
+def bench_sharding(brokers=(1, 2, 4), producers=4, messages=20000, ports=64):
+    """
+    Measures throughput of port messages sharded among several brokers
+    and balance of the placement of the ports.
+
+    Every broker is served over Unix domain socket by its own process.
+    Producer threads send the messages to the ports, which are subscribed
+    by the same client. Measurement ends, when all messages are received
+    or none is received for 10s. Column moved is the share of ports placed
+    on another broker than in the previous row.
+
+    brokers --      numbers of brokers
+    producers --    number of threads sending port messages
+    messages --     number of port messages sent by all producers
+    ports --        number of port topics
+    """
+    print(f'Sharding: {producers} producers, {messages} port messages, {ports} ports')
+    print(f'{"brokers":<20}{"time [s]":>10}{"received":>10}{"messages/s":>12}'
+          f'{"ports min":>10}{"ports max":>10}{"moved":>8}')
+    payload = token_codec.encode([21.5], tFloat)
+    topics = [f'bench-sharding/port-{p}' for p in range(ports)]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transport.py')
+    directory = tempfile.mkdtemp()
+    servers = []
+    previous = None
+    try:
+        for count in brokers:
+            while len(servers) < count:
+                path = os.path.join(directory, f'broker-{len(servers)}.sock')
+                servers.append((subprocess.Popen([sys.executable, script, path]), path))
+            for _, path in servers:
+                while not os.path.exists(path):
+                    time.sleep(0.01)
+            sim = PNSim(broker=[f'unix://{path}' for _, path in servers[:count]],
+                        simul_id=f'bench-sharding-{count}', debug=False, virtual=True)
+            mqtt = sim.mqtt
+            received = threading.Semaphore(0)
+            for clients in mqtt.data_clients.values():
+                for client, _ in clients:
+                    client.on_message = lambda *_: received.release()
+            for topic in topics:
+                mqtt.add_subscription(topic, 0)
+            time.sleep(0.5)     # Subscriptions are served
+
+            def produce(number):
+                for i in range(messages // producers):
+                    mqtt.port_publish(topics[(number + i * producers) % ports], payload, 'at_most_once')
+
+            threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            done = 0
+            end = start
+            while done < messages // producers * producers and received.acquire(timeout=10.0):
+                done += 1
+                end = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            placement = [mqtt.placement.broker(topic) for topic in topics]
+            shares = [placement.count(f'unix://{path}') for _, path in servers[:count]]
+            moved = sum(a != b for a, b in zip(placement, previous or placement)) / ports
+            previous = placement
+            mqtt.close()
+            print(f'{count:<20}{end - start:>10.3f}{done:>10}{done / (end - start):>12.0f}'
+                  f'{min(shares):>10}{max(shares):>10}{moved:>8.0%}')
+    finally:
+        for server, path in servers:
+            server.terminate()
+            server.wait()
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+def bench_reconnect(restarts=3, rate=1000, downtime=0.5, interval=2.0, ports=16):
+    """
+    Measures recovery and loss of port messages, when the broker is restarted.
+
+    The broker stand-in is served over Unix domain socket by another process,
+    which is killed and started again after downtime. Sender sends messages
+    delivered at least once at the given rate, receiver counts them.
+    Recovery is the time from the start of the broker to the first message
+    received after it, queued is the number of messages waiting in the outbound
+    queue of the sender at that moment. Messages acknowledged by the broker
+    before it was killed, but not delivered yet, are lost, as the stand-in
+    does not keep them.
+
+    restarts -- number of restarts of the broker
+    rate --     messages sent per second
+    downtime -- seconds between the kill and the start of the broker
+    interval -- seconds between the restarts
+    ports --    number of port topics
+    """
+    print(f'Reconnect: {restarts} restarts, {rate} messages/s, downtime {downtime}s')
+    print(f'{"restart":<20}{"recovery [s]":>14}{"queued":>10}')
+    topics = [f'bench-reconnect/port-{p}' for p in range(ports)]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transport.py')
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'broker.sock')
+
+    def start_broker():
+        server = subprocess.Popen([sys.executable, script, path])
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        return server
+
+    server = start_broker()
+    try:
+        sender, receiver = [
+            PNSim(broker=f'unix://{path}', simul_id=f'bench-reconnect-{role}', debug=False, virtual=True)
+            for role in ('sender', 'receiver')]
+        for sim in (sender, receiver):
+            sim.setup()
+        received = []
+        for client, _ in receiver.mqtt.data_clients[receiver.mqtt.broker]:
+            client.on_message = lambda c, u, message: received.append(
+                (time.perf_counter(), message.payload[-8:]))
+        for topic in topics:
+            receiver.mqtt.add_subscription(topic, 1)
+        time.sleep(0.5)     # Subscriptions are served
+        stop = threading.Event()
+        sent = []
+
+        def produce():
+            start = time.perf_counter()
+            while not stop.is_set():
+                number = len(sent)
+                sender.mqtt.port_publish(topics[number % ports], struct.pack('!Q', number), 'at_least_once')
+                sent.append(number)
+                time.sleep(max(start + len(sent) / rate - time.perf_counter(), 0))
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        for restart in range(restarts):
+            time.sleep(interval)
+            server.kill()
+            server.wait()
+            time.sleep(downtime)
+            server = start_broker()
+            started = time.perf_counter()
+            _, queue = sender.mqtt.data_connection(topics[0])
+            queued = len(queue)
+            while time.perf_counter() - started < 30.0 and not any(t > started for t, _ in received[-10:]):
+                time.sleep(0.01)
+            recovery = min([t for t, _ in received[-1000:] if t > started] or [float('nan')]) - started
+            print(f'{restart + 1:<20}{recovery:>14.3f}{queued:>10}')
+        time.sleep(interval)
+        stop.set()
+        producer.join()
+        progress = time.perf_counter()
+        while len({n for _, n in received}) < len(sent) and time.perf_counter() - progress < 5.0:
+            time.sleep(0.1)
+        unique = len({n for _, n in received})
+        print(f'sent {len(sent)}, received {unique}, lost {len(sent) - unique}, '
+              f'duplicates {len(received) - unique}')
+        for sim in (sender, receiver):
+            sim.mqtt.close()
+    finally:
+        server.kill()
+        server.wait()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+def bench_pipeline(producers=(1, 8, 32), messages=20000, ports=16, lingers=(0.0, 0.001)):
+    """
+    Compares throughput of port messages published directly by the producer
+    threads and by the single writer of the pipeline, which packs messages
+    of one port taken together into one frame.
+
+    Bus is served over Unix domain socket by another process, messages
+    are received by another client. Measurement ends, when all messages
+    are received or none is received for 10s.
+
+    producers --    numbers of threads sending port messages
+    messages --     number of port messages sent by all producers
+    ports --        number of port topics
+    lingers --      linger windows of the pipeline in seconds
+    """
+    print(f'Publishing pipeline: {messages} port messages, {ports} ports')
+    print(f'{"publishing":<20}{"producers":>10}{"time [s]":>10}{"received":>10}'
+          f'{"messages/s":>12}{"frames":>10}')
+    payload = token_codec.encode([21.5], tFloat)
+    topics = [f'bench-pipeline/port-{p}' for p in range(ports)]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transport.py')
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'broker.sock')
+    server = subprocess.Popen([sys.executable, script, path])
+    modes = [('direct', False, 0.0)] + [(f'linger {linger * 1e3:g}ms', True, linger) for linger in lingers]
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        for name, pipeline, linger in modes:
+            for count in producers:
+                defaults = Mqtt_client.PIPELINE, Mqtt_client.PUBLISH_LINGER
+                Mqtt_client.PIPELINE, Mqtt_client.PUBLISH_LINGER = pipeline, linger
+                try:
+                    sender, receiver = [
+                        PNSim(broker=f'unix://{path}', simul_id=f'bench-pipeline-{role}', debug=False, virtual=True)
+                        for role in ('sender', 'receiver')]
+                finally:
+                    Mqtt_client.PIPELINE, Mqtt_client.PUBLISH_LINGER = defaults
+                sender.mqtt.remote_batches.add('bench-pipeline')
+                received = threading.Semaphore(0)
+
+                def receive(client, userdata, message):
+                    for _ in unpack_batch(message.payload):
+                        received.release()
+
+                for client, _ in receiver.mqtt.data_clients[receiver.mqtt.broker]:
+                    client.on_message = receive
+                for topic in topics:
+                    receiver.mqtt.add_subscription(topic, 0)
+                time.sleep(0.5)     # Subscriptions are served
+
+                def produce(number):
+                    for i in range(messages // count):
+                        sender.mqtt.port_publish(topics[(number + i * count) % ports], payload, 'at_most_once')
+
+                threads = [threading.Thread(target=produce, args=(n,)) for n in range(count)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                done = 0
+                end = start
+                while done < messages // count * count and received.acquire(timeout=10.0):
+                    done += 1
+                    end = time.perf_counter()
+                for thread in threads:
+                    thread.join()
+                frames = sender.mqtt.publish_stats['frames']
+                for sim in (sender, receiver):
+                    sim.mqtt.close()
+                print(f'{name:<20}{count:>10}{end - start:>10.3f}{done:>10}'
+                      f'{done / (end - start):>12.0f}{frames:>10}')
+    finally:
+        server.terminate()
+        server.wait()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+BENCHMARKS = {
+    'scheduler': bench_scheduler,
+    'compiler': bench_compiler,
+    'joins': bench_joins,
+    'ordering': bench_ordering,
+    'codec': bench_codec,
+    'local': bench_local,
+    'routing': bench_routing,
+    'planes': bench_planes,
+    'transports': bench_transports,
+    'rings': bench_rings,
+    'sharding': bench_sharding,
+    'reconnect': bench_reconnect,
+    'pipeline': bench_pipeline,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f'Unknown benchmark "{name}", choose from: {", ".join(BENCHMARKS)}')
+        BENCHMARKS[name]()
@@ -1,7 +1,52 @@
 #!/bin/python3.7
 
-import paho.mqtt.client as mqtt
-from threading import Lock
+import os
+import time
+import zlib
+import struct
+import bisect
+import hashlib
+import logging
+from threading import Lock, Condition, Timer, Thread
+from collections import deque
+from itertools import count
+import token_codec
+import transport
+import shm_ring
+import outbound
+from target_buffer import TargetBuffer
+
+# Header of port messages sent at least once: magic byte, sender and sequence number.
+# Payloads of tokens start with zero byte (binary format) or letter (text format)
+SEQUENCED = b'\x01'
+_sequence_header = struct.Struct('!cqQ')
+# Port message carrying several payloads, each prefixed by its length
+BATCHED = b'\x02'
+_batch_length = struct.Struct('!I')
+
+
+def pack_batch(payloads):
+    '''
+    Returns port message carrying all the payloads.
+    '''
+    return BATCHED + b''.join(_batch_length.pack(len(payload)) + payload for payload in payloads)
+
+
+def unpack_batch(payload):
+    '''
+    Returns list of payloads of the port message, which may be batched.
+    '''
+    if payload[:1] != BATCHED:
+        return [payload]
+    payloads = []
+    offset = 1
+    while offset < len(payload):
+        length, = _batch_length.unpack_from(payload, offset)
+        offset += _batch_length.size
+        payloads.append(payload[offset:offset + length])
+        offset += length
+    return payloads
+
 
 def simulationFailure(simul, msg):
     import sys
@@ -9,36 +54,308 @@ def simulationFailure(simul, msg):
     sys.stderr.write(msg)
     simul.wake()
 
+class PortQueue():
+    '''
+    Bounded queue of messages received by the input ports and of tokens
+    sent by local nets, waiting for execution of their nets.
+
+    Messages are kept per net, so all messages of the net are taken
+    at once before its execution. When the queue is full, the policy
+    decides what happens with the next message:
+        block --        receiving thread waits until there is a free space,
+                        at most for the timeout, then message sent at most
+                        once is dropped, other messages are queued over
+                        the size, so delivery of the port is kept
+        drop_oldest --  the oldest queued message is dropped
+        drop_newest --  the received message is dropped
+    Messages are received by the network thread of the client, which does
+    not serve the connection while it waits, so it never waits unbounded.
+    Once the queue is over its size, messages are not waited for anymore,
+    until the nets take their messages.
+    '''
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, size=10000, policy=BLOCK, timeout=0.1):
+        '''
+        size --     maximum of queued messages
+        policy --   handling of the message, when the queue is full
+        timeout --  seconds to wait for a free space by policy block
+        '''
+        if not isinstance(size, int) or size < 1:
+            raise ValueError(f'Expected positive size of queue, got {size}')
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown queue policy "{policy}", choose from: {", ".join(self.POLICIES)}')
+        if timeout is None or timeout < 0:
+            raise ValueError(f'Expected non-negative timeout of queue, got {timeout}')
+        self.size = size
+        self.policy = policy
+        self.timeout = timeout
+        self.nets = {}      # Net name -> deque of (sequence, place, payload or list of tokens)
+        self.length = 0
+        self.sequence = count()
+        self.cond = Condition()
+        self.closed = False
+        self.dropped = 0
+        self.overflowed = 0     # Messages queued over the size by policy block
+        self.high_water = 0
+
+    def __len__(self):
+        with self.cond:
+            return self.length
+
+    def put(self, net, place, payload, reliable=True):
+        '''
+        Queues the message for the net. Returns True, when the net had no
+        messages waiting, so its execution should be planned.
+
+        net --      name of the target net
+        place --    target place of the net
+        payload --  encoded tokens
+        reliable -- message is not sent at most once, policy block never drops it
+        '''
+        with self.cond:
+            if self.length >= self.size:
+                if self.policy == self.BLOCK:
+                    overflowing = self.length > self.size
+                    if overflowing or not self.cond.wait_for(
+                            lambda: self.length < self.size or self.closed, self.timeout):
+                        if not reliable:
+                            self.dropped += 1
+                            if not overflowing:
+                                logging.warning(
+                                    f'Port queue is full for {self.timeout}s, message for "{net}" dropped')
+                            return False
+                        self.overflowed += 1
+                        if not overflowing:
+                            logging.warning(
+                                f'Port queue is full for {self.timeout}s, messages are queued over its size')
+                elif self.policy == self.DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    self.dropped += 1
+                    return False
+            if self.closed:
+                return False
+            messages = self.nets.setdefault(net, deque())
+            messages.append((next(self.sequence), place, payload))
+            self.length += 1
+            self.high_water = max(self.high_water, self.length)
+            return len(messages) == 1
+
+    def take(self, net):
+        '''
+        Removes and returns all messages of the net as list of (place, payload).
+        '''
+        with self.cond:
+            messages = self.nets.pop(net, ())
+            self.length -= len(messages)
+            self.cond.notify_all()
+        return [(place, payload) for _, place, payload in messages]
+
+    def close(self):
+        '''
+        Releases threads blocked in put, further messages are refused.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _drop_oldest(self):
+        net = min(self.nets, key=lambda n: self.nets[n][0][0])
+        self.nets[net].popleft()
+        if not self.nets[net]:
+            del self.nets[net]
+        self.length -= 1
+        self.dropped += 1
+
+
+class TopicPlacement():
+    '''
+    Assigns port topics to the brokers by consistent hashing.
+
+    Every broker owns VIRTUAL_NODES points on the ring of 64-bit hashes,
+    the topic belongs to the broker of the first point after the hash
+    of the topic. Placement depends only on the addresses of the brokers,
+    so clients configured with the same brokers agree on it without
+    coordination, and adding a broker moves only topics of its new points.
+    '''
+    VIRTUAL_NODES = 100
+
+    def __init__(self, brokers):
+        if not brokers:
+            raise ValueError('Expected at least one broker address')
+        self.brokers = list(brokers)
+        points = sorted((self.hash(f'{broker}#{node}'), broker)
+                        for broker in set(self.brokers) for node in range(self.VIRTUAL_NODES))
+        self.points = [point for point, _ in points]
+        self.owners = [broker for _, broker in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def broker(self, topic):
+        '''
+        Returns address of the broker of the topic.
+        '''
+        if len(self.brokers) == 1:
+            return self.brokers[0]
+        index = bisect.bisect(self.points, self.hash(topic)) % len(self.points)
+        return self.owners[index]
+
+
 class Mqtt_client():
+    REGISTRY = 'registry/'  # Prefix of retained registrations of the nets, "registry/<net>"
+    SESSIONS = 'sessions/'  # Prefix of retained sessions of connected clients, "sessions/<session>"
+    SESSION_CLOSED = b'closed'  # Session left by last will, hbmqtt refuses empty will message
+    TOKEN_FORMATS = token_codec.FORMATS     # Accepted token formats in order of preference
+    BATCH_FORMAT = 'batch1'     # Advertised with token formats by clients accepting batched port messages
+    LOCAL_DELIVERY = True   # Tokens for local nets are queued for their places without encoding
+    PORT_QUEUE_SIZE = 10000     # Maximum of received port messages waiting for execution
+    PORT_QUEUE_POLICY = PortQueue.BLOCK     # Handling of port messages, when the queue is full
+    PORT_QUEUE_TIMEOUT = 0.1    # Seconds the receiving thread waits for space in the full queue,
+                                # then messages sent at most once are dropped, others exceed the size
+    BUFFER_SIZE = 1000  # Maximum of port messages kept in memory for a net not registered yet
+    BUFFER_POLICY = TargetBuffer.DROP_OLDEST    # Handling of port messages over the size
+    REQUEST_BATCH = 100     # Maximum of port requests sent in one message
+    REQUEST_TIMEOUT = 5.0   # Seconds to wait for response, before the request is sent again
+    REQUEST_RETRIES = 3     # Repeated sendings of the request, before the setup fails
+    WILDCARD_SUBSCRIPTIONS = True   # Single subscription "<net>/#" for all input ports of the net
+    DATA_CONNECTIONS = 1    # Connections for port messages, 0 shares the control connection
+                            # of the primary broker, other brokers have at least one
+    SHARED_MEMORY = True    # Input ports offer shared memory rings to senders on the same host
+    RING_SIZE = 1 << 20     # Size of the ring of one port in bytes
+    RING_TIMEOUT = 1.0      # Seconds to wait for space in the ring, before the broker is used
+    JOURNAL = True      # Messages with QoS > 0 are kept in the journal file, until the broker acknowledges them
+    RECONNECT_MIN_DELAY = 0.1   # Seconds before the first attempt to reconnect, doubled after failures
+    RECONNECT_MAX_DELAY = 10.0
+    RESUBSCRIBE_DELAY = 0.2     # Seconds to hold queued messages after reconnection, so receivers
+                                # reconnected at the same time subscribe their ports again
+    CLOSE_TIMEOUT = 1.0     # Seconds to wait for acknowledgement of published messages on close
+    PIPELINE = True     # Port messages are published by single writer thread, not by their producers
+    PUBLISH_LINGER = 0.001  # Seconds the writer waits for more port messages to pack together
+    PIPELINE_SIZE = 10000   # Maximum of port messages waiting for the writer, lost by crash
+    PIPELINE_POLICY = outbound.Pipeline.BLOCK   # Handling of port messages, when the pipeline is full
+    BATCH_SIZE = 64 << 10   # Maximum size of payloads packed into one port message in bytes
+    EXACTLY_ONCE = 'exactly_once'
+    DELIVERY_QOS = {    # QoS of port messages by delivery mode of the port
+        'at_most_once': 0,
+        'at_least_once': 1,
+        EXACTLY_ONCE: 2,
+    }
 
-    def __init__(self, simul, brok_addr='127.0.0.1'):
-        self.broker = brok_addr
+    def __init__(self, simul, brok_addr='127.0.0.1', queue_size=None, queue_policy=None, queue_timeout=None):
+        '''
+        simul --        simulator of the hosted nets
+        brok_addr --    address of the broker, or list of addresses, port topics
+                        are sharded among them by TopicPlacement, control
+                        messages and the registry use the first one
+        queue_size --   maximum of received port messages waiting for execution,
+                        PORT_QUEUE_SIZE by default
+        queue_policy -- handling of port messages, when the queue is full,
+                        one of PortQueue.POLICIES, PORT_QUEUE_POLICY by default
+        queue_timeout -- seconds to wait for space in the full queue by policy
+                        block, then messages sent at most once are dropped,
+                        others are queued over the size, PORT_QUEUE_TIMEOUT
+                        by default
+        '''
+        brokers = [brok_addr] if isinstance(brok_addr, str) else list(brok_addr)
+        self.broker = brokers[0]    # Primary broker
+        self.placement = TopicPlacement(brokers)
         self.simul = simul
         self.nets = {}
         self.remote_nets = set()
-        self.remote_requests = {}
-        self.lock = Lock()
-        self.pending_requests = []
-        self.pending_req_cnt = 0
-        self.client = None
+        self.remote_formats = {}    # Token format negotiated for every remote net
+        self.remote_batches = set()     # Remote nets accepting batched port messages
+        self.registry = {}  # Client ID, session and formats of the owner of every registered net
+        self.sessions = set()   # Sessions of connected clients
+        # Identifies connection of the client, the registered nets are valid
+        # only while the session is retained, last will of the client removes it
+        self.session = os.urandom(8).hex()  # Not affected by seeding of random by the nets
+        self.remote_requests = {}   # Control requests for nets not registered yet
+        self.remote_buffers = {}    # Buffered port messages for nets not registered yet
+        self.pending_requests = {}  # Request ID -> [message, number of sendings]
+        self.request_ids = count()
+        self.requests_cond = Condition()
+        self.requests_failed = False
+        self.request_stats = {'requests': 0, 'messages': 0, 'retries': 0}
+        self.startup_times = {}     # Phase of configure -> duration in seconds
+        self.port_queue = PortQueue(
+            self.PORT_QUEUE_SIZE if queue_size is None else queue_size,
+            queue_policy or self.PORT_QUEUE_POLICY,
+            self.PORT_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout)
+        # Sequence numbers continue across restarts, so receivers do not drop new messages
+        self.sequence = count(time.time_ns())
+        self.last_sequence = {}     # Last received sequence number by topic and sender
+        self.routes = {}    # Net name and place by topic of every input port
+        self.subscriptions = {}     # QoS by subscribed topic filter
+        self.client = None  # Control connection
+        self.client_id = None   # Identifies the client in control messages, set by configure
+        self.journal = outbound.Journal()   # Messages not acknowledged by the brokers
+        self.outbound = None    # Outbound queue of the control connection
+        self.data_clients = {}  # Broker -> connections for port messages and their outbound queues
+        self.rings = {}     # Shared memory ring by topic of the remote input port
+        self.ring_reader = None     # Reader of rings offered to the senders
+        self.publish_stats = {'messages': 0, 'frames': 0}   # Port messages and sent frames
+        self.pipeline = outbound.Pipeline(
+            self.send_port_messages, self.PUBLISH_LINGER, self.PIPELINE_SIZE, self.PIPELINE_POLICY) \
+            if self.PIPELINE else None
         self.setup_client()
 
     def on_message(self, client, userdata, message):
+        route = self.routes.get(message.topic)
+        if route is not None:
+            self.serve_port(route, message.topic, message.payload, message.qos > 0)
+            return
+        if message.topic.startswith(self.REGISTRY):
+            self.serve_registry(message.topic[len(self.REGISTRY):], message.payload)
+            return
+        if message.topic.startswith(self.SESSIONS):
+            self.serve_session(message.topic[len(self.SESSIONS):], message.payload)
+            return
         data = self.parse_msg(message)
         if data['topic'] == 'control':
             self.serve_control(data)
         elif data['topic'] == 'private':
             self.serve_private(data)
-        else:
-            self.serve_port(data)
+
+    def on_port_message(self, client, userdata, message):
+        route = self.routes.get(message.topic)
+        if route is not None:
+            self.serve_port(route, message.topic, message.payload, message.qos > 0)
 
     def close(self):
+        self.port_queue.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if self.ring_reader:
+            self.ring_reader.close()
         if self.client:
-            remove_nets = f'U, remove_nets, {self.client._client_id}, {"&".join(self.nets.keys())}'
-            self.publish('control', remove_nets, 2)
-            self.client.loop_stop()
+            for net in self.nets.keys():    # Empty retained message removes the registration
+                self.publish(f'{self.REGISTRY}{net}', b'', 1, retain=True)
+            self.publish(f'{self.SESSIONS}{self.session}', b'', 1, retain=True)
+            # Broker may keep subscriptions of the disconnected client
+            for topic in self.subscriptions:
+                for client, _ in self.subscription_connections(topic):
+                    client.unsubscribe(topic)
+            self.client.unsubscribe([
+                'control', f'private/{self.client_id}', f'{self.SESSIONS}#', f'{self.REGISTRY}#'])
+        connections = [(self.client, self.outbound)] + [
+            connection for clients in self.data_clients.values() for connection in clients]
+        deadline = time.monotonic() + self.CLOSE_TIMEOUT
+        for client, queue in connections:
+            if queue is not None:
+                queue.join(max(deadline - time.monotonic(), 0))
+        for client, _ in connections:
+            if client:
+                client.disconnect()
+                client.loop_stop()
+        self.journal.close()
 
-    def add_subscription(self, topic):
+    def add_subscription(self, topic, qos=2):
         if not self.client:
             raise Exception("Client was not configured")
         if isinstance(topic, (list, set)) and len(topic) == 2:
@@ -48,122 +365,263 @@ class Mqtt_client():
                 "Not an valuable topic format, must be str/list/set")
         else:
             topic_str = topic
-        self.client.subscribe(topic_str, qos=2) # Subscribe with best qos
+        if self.subscriptions.get(topic_str, -1) >= qos:
+            return  # Already subscribed with the same or better qos
+        self.subscriptions[topic_str] = qos
+        for client, _ in self.subscription_connections(topic_str):
+            client.subscribe(topic_str, qos=qos)
 
     def serve_control(self, message):
         '''
         Provides backend API processing for port setup
         '''
         if message['type'] == 'R':
-            if message['target_net'] not in self.nets.keys():
-                return
-            net = self.nets[message['target_net']]
-            if not net.has_place(message['target_place']):
-                self.control_publish(
-                    f"F, {message['payload']} - " +
-                    f'Error: place "{message["target_place"]}" was not found in net "{net.name}"')
-            try:
-                if message['action'] == 'set_input':
-                    self.configure_internal_input_port(
-                        message['target_net'],
-                        message['target_place'])
-                elif message['action'] == 'set_output':
-                    self.configure_internal_output_port(
-                        message['target_net'],
-                        message['target_place'],
-                        message['source_topic'])
-                else:
-                    raise Exception(f'Unknown message action {message}')
-            except:
-                self.control_publish(
-                    f"F, {message['payload']} - " +
-                    "Error while serving message")
+            request = message['request']
+            if request['target_net'] not in self.nets.keys():
                 return
+            error = self.serve_request(request)
+            if error:
+                self.control_publish(f"F, {message['payload']} - {error}")
             else:
                 self.control_publish(f"S, {message['payload']}")
+        elif message['type'] == 'B':
+            requests = message['requests']
+            if not requests or requests[0]['target_net'] not in self.nets.keys():
+                return
+            errors = [error for error in map(self.serve_request, requests) if error]
+            if errors:
+                self.control_publish(f"F, {message['id']} - {'; '.join(errors)}")
+            else:
+                self.control_publish(f"S, {message['id']}")
         elif message['type'] == 'U':
             if message['action'] == 'update_nets':
-                if message['client_id'] == str(self.client._client_id):
+                if message['client_id'] == str(self.client_id):
                     return
                 # Notify source to update it's list of remote nets
-                self.remote_nets.update(message['nets'])
-                new_net_list = f"U, update_nets, {message['client_id']}, {'&'.join(self.nets.keys())}"
+                self.add_remote_nets(message['nets'], message['formats'])
+                new_net_list = f"U, update_nets, {message['client_id']}, {'&'.join(self.nets.keys())}, " \
+                               f"{self.formats()}"
                 self.private_publish(message['client_id'], new_net_list)
                 for net in message['nets']:
-                    if not net in self.remote_requests.keys():
-                        continue
                     self.remote_requests_pop(net)
             elif message['action'] == 'remove_nets':
                 for net in message['nets']:
-                    if net not in self.remote_nets:
-                        continue
-                    self.remote_nets.remove(net)
+                    self.remove_remote_net(net)
         elif message['type'] == 'F':
+            with self.requests_cond:
+                self.requests_failed = True
+                self.requests_cond.notify_all()
             simulationFailure(
                 self.simul, f"Failed to setup: {message['payload']}")
             self.close()
         elif message['type'] == 'S':
-            if message['content'] not in self.pending_requests:
-                return
-            self.pending_requests.remove(message['content'])
-            self.pending_req_cnt -= 1
-            if self.pending_req_cnt == 0:
-                self.simul.wake()
+            with self.requests_cond:
+                if self.pending_requests.pop(message['content'], None) is None:
+                    return
+                if not self.pending_requests:
+                    self.requests_cond.notify_all()
 
-    def serve_port(self, message):
-        net, place = message['topic'].split('/')
-        if net not in self.nets.keys():
+    def serve_registry(self, net, payload):
+        '''
+        Updates the remote nets by the registration of the net
+        "CLIENT_ID, SESSION, FORMATS", empty payload means the net was removed.
+        The net is used, once the session of its owner is known to be connected.
+        '''
+        if not payload:
+            self.remove_remote_net(net)
+            return
+        client_id, session, formats = payload.decode('utf-8').split(', ')
+        if session == self.session:
+            return
+        self.registry[net] = (client_id, session, formats.split('&'))
+        if session in self.sessions:
+            self.activate_remote_net(net)
+
+    def serve_session(self, session, payload):
+        '''
+        Updates the connected sessions. Empty payload means the client
+        disconnected, SESSION_CLOSED that it was disconnected unexpectedly,
+        its nets are removed from the registry then, together with its shared
+        memory rings left on this host.
+
+        Retained messages left by the last will are not cleared, the client
+        may have reconnected and registered its nets again meanwhile. Nets
+        of the closed session are never used, the restarted client replaces
+        its registrations. The client, which receives the last will of its
+        own connection, announces the session again.
+        '''
+        if session == self.session:
+            if payload == self.SESSION_CLOSED and self.client_id is not None:
+                self.publish(f'{self.SESSIONS}{self.session}', str(self.client_id), 1, retain=True)
+            return
+        nets = [net for net, entry in self.registry.items() if entry[1] == session]
+        if payload and payload != self.SESSION_CLOSED:
+            self.sessions.add(session)
+            for net in nets:
+                self.activate_remote_net(net)
             return
-        place = self.nets[net].place(place)
-        tokens = message['payload'].split('&')
-        self.parse_tokens(place, tokens)
-        self.simul.execute_net(net)
-
-    def parse_tokens(self, place, tokens):
-        for tp, val in map(lambda x: x.split(':', 1), tokens):
-            tk = self.parse_subtokens(tp, val)
-            place.add(tk)
-
-    def parse_subtokens(self, tp, value):
-        tp = eval(tp) # Type casting
-        if tp == tuple:
-            parsed_tokens = []
-            value = eval(value) # Converting string list to list
-            for tp_v, val in map(lambda x: x.split(':'), value):
-                tk = self.parse_subtokens(tp_v, val)
-                parsed_tokens.append(tk)
-            return tuple([tp(parsed_tokens)])
-        elif tp == bool:
-            return value == 'True'
+        self.sessions.discard(session)
+        for net in nets:    # Registrations left by the disconnected client
+            self.remove_remote_net(net)
+        shm_ring.remove_files(self.ring_name(session))  # Rings left on this host
+
+    def activate_remote_net(self, net):
+        _, _, formats = self.registry[net]
+        self.add_remote_nets({net}, formats)
+        self.remote_requests_pop(net)
+
+    def remove_remote_net(self, net):
+        self.registry.pop(net, None)
+        self.remote_nets.discard(net)
+        self.remote_formats.pop(net, None)
+        self.remote_batches.discard(net)
+        for topic in [topic for topic in self.rings if topic.split('/', 1)[0] == net]:
+            del self.rings[topic]
+        if self.ring_reader is not None:    # Rings offered to the net
+            self.ring_reader.remove(producer=net)
+
+    def serve_request(self, request):
+        '''
+        Configures the port of hosted net by the request.
+        Returns error message, None when the port was configured.
+        '''
+        net = self.nets[request['target_net']]
+        if not net.has_place(request['target_place']):
+            return f'Error: place "{request["target_place"]}" was not found in net "{net.name}"'
+        try:
+            if request['action'] == 'set_input':
+                self.configure_internal_input_port(
+                    request['target_net'],
+                    request['target_place'],
+                    request['source_topic'],
+                    request['delivery'])
+                self.request_ring(
+                    request['source_topic'],
+                    f"{request['target_net']}/{request['target_place']}",
+                    request['delivery'])
+            elif request['action'] == 'set_output':
+                self.configure_internal_output_port(
+                    request['target_net'],
+                    request['target_place'],
+                    request['source_topic'],
+                    request['delivery'],
+                    request['ring'])
+            else:
+                raise Exception(f'Unknown message action {request}')
+        except:
+            return 'Error while serving message'
+        return None
+
+    def serve_port(self, route, topic, payload, reliable=True):
+        '''
+        Queues the message for the net, tokens are added to the place
+        right before the net execution in the simulator. Batched message
+        is queued as its payloads.
+
+        route --    net name and place of the port
+        topic --    topic of the message
+        payload --  encoded tokens
+        reliable -- message was not sent at most once, it is never dropped
+                    by the full queue of policy block, see PortQueue
+        '''
+        net, place = route
+        if payload[:1] == SEQUENCED:
+            _, sender, sequence = _sequence_header.unpack_from(payload)
+            key = (topic, sender)
+            if sequence <= self.last_sequence.get(key, -1):
+                return  # Duplicate of already received message
+            self.last_sequence[key] = sequence
+            payload = payload[_sequence_header.size:]
+        planned = False
+        for payload in unpack_batch(payload):
+            planned |= self.port_queue.put(net, place, payload, reliable)
+        if planned:
+            self.simul.schedule_at([self.simul.execute_net, net], self.simul.NOW)
+
+    def serve_local(self, net, place, payload):
+        '''
+        Queues tokens sent by the net of this simulator to the port of other
+        local net, they are added to the place right before the execution
+        of the net, as tokens of received port messages.
+
+        net --      name of the target net
+        place --    target place of the net
+        payload --  encoded tokens, or list of tokens added without decoding
+        '''
+        if self.port_queue.put(net, place, payload):
+            self.simul.schedule([self.simul.execute_net, net], self.simul.NOW)
+
+    def deliver_port_messages(self, net):
+        '''
+        Adds tokens of all queued messages of the net to their places.
+        Returns number of delivered messages.
+        '''
+        messages = self.port_queue.take(net)
+        for place, payload in messages:
+            if isinstance(payload, list):   # Tokens of local net
+                place.add(payload)
+            else:
+                self.parse_tokens(place, payload)
+        return len(messages)
+
+    def parse_tokens(self, place, payload):
+        '''
+        Adds tokens from the message payload of any format to the place.
+        '''
+        place.add(token_codec.decode(payload))
+
+    def encode_tokens(self, net, tokens, check=None):
+        '''
+        Encodes tokens to the payload in the format negotiated with the net.
+        '''
+        fmt = self.remote_formats.get(net, token_codec.TEXT)
+        return token_codec.encode(tokens, check, fmt)
+
+    def add_remote_nets(self, nets, formats):
+        fmt = token_codec.negotiate([f for f in self.TOKEN_FORMATS if f in formats])
+        self.remote_nets.update(nets)
+        for net in nets:
+            self.remote_formats[net] = fmt
+        if self.BATCH_FORMAT in formats:
+            self.remote_batches.update(nets)
         else:
-            return tp(value)
+            self.remote_batches.difference_update(nets)
+
+    def formats(self):
+        '''
+        Returns accepted formats of port messages advertised to other clients.
+        '''
+        return '&'.join(self.TOKEN_FORMATS + (self.BATCH_FORMAT,))
 
     def serve_private(self, message):
         if message['type'] == 'U':
             if message['action'] == 'update_nets':
-                self.remote_nets.update(message['nets'])
+                self.add_remote_nets(message['nets'], message['formats'])
                 for net in message['nets']:
-                    if not net in self.remote_requests.keys():
-                        continue
                     self.remote_requests_pop(net)
 
     def input_port_setup(self, net, trg_place, from_topic):
         if isinstance(from_topic, list):
             from_topic = '/'.join(from_topic)
-        self.configure_internal_input_port(net, trg_place)
-        self.configure_external_output_port(net, trg_place, from_topic)
+        delivery = trg_place.delivery_mode(from_topic)
+        self.configure_internal_input_port(net, trg_place, from_topic, delivery)
+        self.configure_external_output_port(net, trg_place, from_topic, delivery)
 
-    def configure_external_output_port(self, net, trg_place, from_topic):
+    def configure_external_output_port(self, net, trg_place, from_topic, delivery=EXACTLY_ONCE):
         trg_topic = '{}/{}'.format(net.name, trg_place.name)
         net, place = from_topic.split('/')
         if not net in self.nets.keys():
-            self.serve_output(from_topic, trg_topic, net)
+            self.serve_output(from_topic, trg_topic, net, delivery)
             return
-        self.configure_internal_output_port(net, place, trg_topic)
+        self.configure_internal_output_port(net, place, trg_topic, delivery)
 
-    def configure_internal_input_port(self, net, place):
-        input_port_topic = '{}/{}'.format(net, place)
-        self.add_subscription(input_port_topic)
+    def configure_internal_input_port(self, net, place, from_topic=None, delivery=EXACTLY_ONCE):
+        '''
+        Subscribes to the topic of the input port, with QoS of the strongest
+        delivery mode requested by the senders, and adds the port to routes.
+        When WILDCARD_SUBSCRIPTIONS is set, all ports of the net share
+        single subscription "<net>/#" with the best QoS of the ports.
+        '''
         if isinstance(net, str):
             net = self.nets[net]
         if isinstance(place, str):
@@ -175,21 +633,54 @@ class Mqtt_client():
                     f'Error: place "{place}" is not found in net "{net.name}"')
                 return
         place.set_place_type(place.INPUT)
+        place.set_delivery(from_topic or '/', delivery)
+        input_port_topic = '{}/{}'.format(net.name, place.name)
+        self.routes[input_port_topic] = (net.name, place)
+        qos = self.DELIVERY_QOS[place.delivery_mode()]
+        if self.WILDCARD_SUBSCRIPTIONS:
+            self.add_subscription(f'{net.name}/#', qos)
+        else:
+            self.add_subscription(input_port_topic, qos)
+
+    def remote_inputs(self):
+        '''
+        Returns True, when an input port of the hosted nets receives tokens
+        from nets of other simulators, so port messages may still plan
+        executions of the nets.
+        '''
+        for _, place in self.routes.values():
+            for topic in place.delivery:    # Source topics of the port
+                if topic.split('/', 1)[0] not in self.nets.keys():
+                    return True
+        return False
+
+    def route(self, topic):
+        '''
+        Returns net name and place of the input port, which receives
+        messages of the topic, None for unknown topics.
+        '''
+        return self.routes.get(topic)
 
     def output_port_setup(self, net, trg_place, to_topic):
         if isinstance(to_topic, list):
             to_topic = '/'.join(to_topic)
-        self.configure_internal_output_port(net.name, trg_place, to_topic)
-        self.configure_external_input_port(to_topic)
+        delivery = trg_place.delivery_mode(to_topic)
+        self.configure_internal_output_port(net.name, trg_place, to_topic, delivery)
+        self.configure_external_input_port(
+            to_topic, '{}/{}'.format(net.name, trg_place.name), delivery)
 
-    def configure_external_input_port(self, target_port_topic):
+    def configure_external_input_port(self, target_port_topic, src_topic='/', delivery=EXACTLY_ONCE):
         net, place = target_port_topic.split('/')
         if net not in self.nets.keys():
-            self.serve_input(target_port_topic, net)
+            self.serve_input(target_port_topic, net, src_topic, delivery)
             return
-        self.configure_internal_input_port(net, place)
+        self.configure_internal_input_port(net, place, src_topic, delivery)
 
-    def configure_internal_output_port(self, net, trg_place, to_topic):
+    def configure_internal_output_port(self, net, trg_place, to_topic, delivery=EXACTLY_ONCE, ring=None):
+        '''
+        Adds the topic to the output port. Tokens are sent through the ring,
+        when the receiver offered it and it is accessible on this host.
+        '''
         if isinstance(net, str):
             net = self.nets[net]
         if isinstance(trg_place, str):
@@ -202,14 +693,111 @@ class Mqtt_client():
                 return
         trg_place.set_place_type(trg_place.OUTPUT)
         trg_place.add_output_topic(to_topic)
+        trg_place.set_delivery(to_topic, delivery)
+        target = self.local_port(to_topic)
+        if target is not None and self.LOCAL_DELIVERY:
+            trg_place.local_targets[to_topic] = target
+        elif ring and self.SHARED_MEMORY and to_topic not in self.rings:
+            try:
+                self.rings[to_topic] = shm_ring.Ring.attach(ring)
+            except OSError:
+                pass    # Receiver runs on another host
+
+    def local_port(self, topic):
+        '''
+        Returns net name and place of the port topic, if the net is hosted
+        by this simulator, None otherwise.
+        '''
+        net, place = topic.split('/', 1)
+        if net not in self.nets.keys() or not self.nets[net].has_place(place):
+            return None
+        return net, self.nets[net].place(place)
 
 
     def setup_client(self):
-        self.client = mqtt.Client()
-        self.client.on_message = self.on_message
-        self.client.connect(self.broker)
-        self.client.loop_start()
+        '''
+        Connects to the brokers by the transport selected by their addresses,
+        see transport.create_client. The control connection is opened
+        to the primary broker, data connections to every broker.
+        '''
+        self.client, self.outbound = self.connect_client(self.broker, self.on_message, will=True)
         self.client.subscribe('control', 2)
+        for broker in self.placement.brokers:
+            if broker in self.data_clients:
+                continue    # Listed twice
+            connections = self.DATA_CONNECTIONS if broker == self.broker else max(self.DATA_CONNECTIONS, 1)
+            self.data_clients[broker] = [
+                self.connect_client(broker, self.on_port_message) for _ in range(connections)]
+
+    def connect_client(self, broker, on_message, will=False):
+        '''
+        Returns connected client of the broker and its outbound queue.
+        Lost connection is opened again by the client with exponential
+        backoff, see on_connect.
+
+        will -- last will of the client removes its session
+        '''
+        client, address = transport.create_client(broker)
+        queue = outbound.OutboundQueue(
+            client, self.journal, transport.resends(client), transport.durable(client))
+        client.on_message = on_message
+        client.on_connect = lambda client, userdata, flags, rc: self.on_connect(queue, rc)
+        client.on_disconnect = queue.on_disconnect
+        client.on_publish = queue.on_publish
+        client.reconnect_delay_set(self.RECONNECT_MIN_DELAY, self.RECONNECT_MAX_DELAY)
+        if will:
+            client.will_set(f'{self.SESSIONS}{self.session}', self.SESSION_CLOSED, 1, retain=True)
+        client.connect(*address)
+        client.loop_start()
+        return client, queue
+
+    def on_connect(self, queue, rc):
+        '''
+        Sends queued messages of the connection, after reconnection
+        the topics are subscribed and the nets are registered again first,
+        as the broker may have lost them. The thread of the client keeps
+        receiving meanwhile.
+        '''
+        if rc == 0:
+            Thread(target=self.restore_connection, args=(queue,), daemon=True).start()
+
+    def restore_connection(self, queue):
+        if queue.connections:
+            client = queue.client
+            logging.info(f'Reconnected to broker, {len(queue)} messages queued')
+            for topic, qos in list(self.subscriptions.items()):
+                if any(c is client for c, _ in self.subscription_connections(topic)):
+                    client.subscribe(topic, qos)
+            if client is self.client:
+                client.subscribe('control', 2)
+                if self.client_id is not None:  # Configured already
+                    client.subscribe(f'private/{self.client_id}', 2)
+                    self.notify_others()
+            time.sleep(self.RESUBSCRIBE_DELAY)
+        queue.flush()
+
+    def data_connection(self, topic, broker=None):
+        '''
+        Returns client and outbound queue of the connection for port messages
+        of the topic. The broker is chosen by the placement of the topic,
+        unless it is specified, the connection to it by hash of the topic.
+        Messages of one port are always sent over one connection, so their
+        order is kept.
+        '''
+        clients = self.data_clients.get(broker or self.placement.broker(topic))
+        if not clients:
+            return self.client, self.outbound
+        return clients[zlib.crc32(topic.encode('utf-8')) % len(clients)]
+
+    def subscription_connections(self, topic):
+        '''
+        Returns connections, which subscribe the topic filter. Filter with
+        wildcards may match topics placed on any broker, so it is subscribed
+        on all of them.
+        '''
+        if '+' not in topic and '#' not in topic:
+            return [self.data_connection(topic)]
+        return [self.data_connection(topic, broker) for broker in self.data_clients]
 
     def parse_msg(self, message):
         '''
@@ -217,26 +805,37 @@ class Mqtt_client():
 
         Control message syntax looks like:
             "TYPE ACTION PAYLOAD"
-            TYPE -- message type, [RSFA]
-                    R means request, S means success, F means failure,
+            TYPE -- message type, [RBSFU]
+                    R means request, B batch of requests, S means success,
+                    F means failure, U update of nets
             ACTION -- actions with selected place gathered from topic
             PAYLOAD --  actual message payload, source place name, etc.
+
+        Request message "R, ACTION, TARGET_TOPIC, SOURCE_TOPIC[, DELIVERY]"
+        carries delivery mode of the port, exactly once when it is missing.
+        Batch of requests "B, ID" is followed by lines of requests
+        "ACTION, TARGET_TOPIC, SOURCE_TOPIC, DELIVERY[, RING]" for ports of one net,
+        it is answered by "S, ID" or "F, ID - ERRORS". Single request is
+        answered by the whole request in place of ID. Request set_output
+        may carry path of the shared memory ring offered by the receiver.
         '''
         msg = {}
+        msg['topic'] = message.topic
+        if msg['topic'] != 'control' and 'private' not in msg['topic']:
+            msg['payload'] = message.payload    # Tokens are decoded by the port
+            return msg
         p = message.payload.decode('utf-8')
         msg['payload'] = p
-        msg['topic'] = message.topic
         if msg['topic'] == 'control':
             msg['type'], msg['content'] = p.split(', ', 1)
             if msg['type'] == 'R':
-                msg['action'], target_topic, msg['source_topic'] = msg['content'].split(', ')
-                msg['target_net'], msg['target_place'] = target_topic.split('/')
+                msg['request'] = self.parse_request(msg['content'])
+            elif msg['type'] == 'B':
+                msg['id'], *lines = msg['content'].split('\n')
+                msg['requests'] = [self.parse_request(line) for line in lines]
             elif msg['type'] == 'U':
-                msg['action'], msg['client_id'], nets = msg['content'].split(', ')
-                msg['nets'] = set(nets.split('&'))
-            elif msg['type'] == 'S':
-                _, msg['action'], msg['target_topic'], _ = msg['content'].split(', ')
-            elif msg['type'] != 'F':
+                self.parse_update(msg)
+            elif msg['type'] not in ('S', 'F'):
                 simulationFailure(
                     self.simul,
                     f'Unknown message type for control message: {msg["type"]}')
@@ -245,8 +844,7 @@ class Mqtt_client():
             msg['topic'] = 'private'
             msg['type'], msg['content'] = p.split(', ', 1)
             if msg['type'] == 'U':
-                msg['action'], msg['client_id'], nets = msg['content'].split(', ')
-                msg['nets'] = set(nets.split('&'))
+                self.parse_update(msg)
             else:
                 simulationFailure(
                     self.simul,
@@ -254,65 +852,267 @@ class Mqtt_client():
                 self.close()
         return msg
 
-    def serve_input(self, target_port_topic, net):
-        message = 'R, set_input, {}, /'.format(target_port_topic)
-        if net in self.remote_nets:
-            self.control_publish(message)
-        else:
-            self.update_remote_requests(net, message, 'control')
+    def parse_request(self, content):
+        '''
+        Parses port request "ACTION, TARGET_TOPIC, SOURCE_TOPIC[, DELIVERY[, RING]]"
+        '''
+        fields = content.split(', ')
+        request = {}
+        request['action'], target_topic, request['source_topic'] = fields[:3]
+        request['delivery'] = fields[3] if len(fields) > 3 else self.EXACTLY_ONCE
+        request['ring'] = fields[4] if len(fields) > 4 else None
+        request['target_net'], request['target_place'] = target_topic.split('/')
+        return request
+
+    def parse_update(self, msg):
+        '''
+        Parses update message "U, ACTION, CLIENT_ID, NETS[, FORMATS]"
+            NETS -- names of nets hosted by the client joined by '&'
+            FORMATS -- token formats accepted by the client joined by '&',
+                       clients without this field accept the text format only,
+                       BATCH_FORMAT marks clients accepting batched port messages
+
+        Nets are registered in the registry, update_nets is sent by clients
+        without the registry, e.g. temperature_logger.py.
+        '''
+        fields = msg['content'].split(', ')
+        msg['action'], msg['client_id'], nets = fields[:3]
+        msg['nets'] = set(nets.split('&'))
+        msg['formats'] = fields[3].split('&') if len(fields) > 3 else [token_codec.TEXT]
+
+    def serve_input(self, target_port_topic, net, src_topic='/', delivery=EXACTLY_ONCE):
+        request = f'set_input, {target_port_topic}, {src_topic}, {delivery}'
+        self.update_remote_requests(net, request, 'control')
 
-    def serve_output(self, target_port_topic, src_topic, net):
-        message = 'R, set_output, {}, {}'.format(target_port_topic, src_topic)
+    def serve_output(self, target_port_topic, src_topic, net, delivery=EXACTLY_ONCE):
+        request = f'set_output, {target_port_topic}, {src_topic}, {delivery}'
+        ring = self.offer_ring(src_topic, net)
+        if ring:
+            request += f', {ring}'
+        self.update_remote_requests(net, request, 'control')
+
+    def offer_ring(self, topic, net):
+        '''
+        Returns path of the shared memory ring for messages of the net
+        to the input port, None when shared memory is not used. Only the
+        receiver offers rings, the net sending to the port again, e.g. after
+        reconnection, gets the ring it was offered already.
+        '''
+        if not self.SHARED_MEMORY:
+            return None
+        if self.ring_reader is None:
+            self.ring_reader = shm_ring.RingReader(self.serve_ring, self.ring_name(self.session))
+        return self.ring_reader.create(topic, self.RING_SIZE, net)
+
+    @staticmethod
+    def ring_name(session):
+        return f'pnsim-{session}'
+
+    def request_ring(self, source_topic, topic, delivery=EXACTLY_ONCE):
+        '''
+        Offers the ring to the remote sender, which configured the input port
+        by set_input, by request set_output.
+        '''
+        net = source_topic.split('/', 1)[0]
+        if not self.SHARED_MEMORY or not net or net in self.nets.keys():
+            return
+        request = f'set_output, {source_topic}, {topic}, {delivery}, {self.offer_ring(topic, net)}'
         if net in self.remote_nets:
-            self.control_publish(message)
+            self.send_requests([request])
         else:
-            self.update_remote_requests(net, message, 'control')
+            self.update_remote_requests(net, request, 'control')
+
+    def serve_ring(self, topic, payload):
+        route = self.routes.get(topic)
+        if route is not None:
+            self.serve_port(route, topic, payload)
+
+    def send_requests(self, requests):
+        '''
+        Sends port requests for one net in batches of REQUEST_BATCH requests,
+        the batches are sent again, when they are not answered in REQUEST_TIMEOUT.
+        '''
+        for start in range(0, len(requests), self.REQUEST_BATCH):
+            batch = requests[start:start + self.REQUEST_BATCH]
+            request_id = f'{self.client_id}.{next(self.request_ids)}'
+            message = '\n'.join([f'B, {request_id}'] + batch)
+            with self.requests_cond:
+                self.pending_requests[request_id] = [message, 0]
+                self.request_stats['requests'] += len(batch)
+            self.send_request(request_id)
+
+    def send_request(self, request_id):
+        with self.requests_cond:
+            pending = self.pending_requests.get(request_id)
+            if pending is None:
+                return  # Answered meanwhile
+            message, sendings = pending
+            if sendings > self.REQUEST_RETRIES:
+                self.requests_failed = True
+                self.requests_cond.notify_all()
+                failed = True
+            else:
+                pending[1] += 1
+                self.request_stats['messages'] += 1
+                self.request_stats['retries'] += int(sendings > 0)
+                failed = False
+        if failed:
+            simulationFailure(
+                self.simul, f'Failed to setup: no response to request {request_id}\n')
+            return
+        self.publish('control', message, 2)
+        timer = Timer(self.REQUEST_TIMEOUT, self.send_request, (request_id,))
+        timer.daemon = True
+        timer.start()
 
     def update_remote_requests(self, net, message, topic):
-        if topic != 'control' and self.simul.detached:
+        '''
+        Stores the message for the net, which is not registered yet. Control
+        requests are always kept and sent in batches, once the net is registered,
+        tokens for the ports are buffered in bounded buffer of the net, unless
+        the simulator is detached.
+
+        message -- control request, or tuple (tokens, check, delivery)
+        '''
+        if topic == 'control':
+            self.remote_requests.setdefault(net, []).append(message)
+            return
+        if self.simul.detached:
             return  # Skip the storage part
-        message = [topic, message]
-        if net in self.remote_requests.keys():
-            self.remote_requests[net].append(message)
-        else:
-            self.remote_requests[net] = [message]
+        buffer = self.remote_buffers.get(net)
+        if buffer is None:
+            buffer = TargetBuffer(
+                net, self.BUFFER_SIZE, self.BUFFER_POLICY, f'buffers/{self.simul.id}')
+            buffer = self.remote_buffers.setdefault(net, buffer)
+        buffer.append(topic, *message)
+        if net in self.remote_nets:     # Registered meanwhile
+            self.remote_requests_pop(net)
 
     def remote_requests_pop(self, net):
-        remote_requests = self.remote_requests.pop(net)
-        for msg in remote_requests:
-            topic, message = msg
-            if topic == 'control':
-                self.control_publish(message)
-            else:
-                self.publish(topic, message)
+        '''
+        Sends stored control requests and buffered tokens to the registered net.
+        Tokens are sent as they were buffered, when the net accepts the binary
+        format, otherwise they are encoded again.
+        '''
+        requests = self.remote_requests.pop(net, None)
+        if requests:
+            self.send_requests(requests)
+        buffer = self.remote_buffers.get(net)
+        if buffer is None:
+            return
+        fmt = self.remote_formats.get(net, token_codec.TEXT)
+        for topic, delivery, payload in buffer.take():
+            if fmt != token_codec.BINARY:
+                payload = token_codec.encode(token_codec.decode(payload), fmt=fmt)
+            self.port_publish(topic, payload, delivery)
+
+    def buffer_gauges(self):
+        '''
+        Returns depth and size in bytes of the buffer of every net,
+        which is not registered yet.
+        '''
+        return {net: (buffer.depth(), buffer.bytes())
+                for net, buffer in self.remote_buffers.items() if buffer.depth()}
 
     def control_publish(self, message):
-        if message[0] == 'R':
-            self.pending_requests.append(message)
-            self.pending_req_cnt += 1  # Waiting for ack and success message
         self.publish('control', message, 2)
 
     def private_publish(self, target, message):
         self.publish(f'private/{target}', message, 2)
 
-    def topic_publish(self, topic, tokens):
-        net, place = topic.split('/')
+    def topic_publish(self, topic, tokens, check=None, delivery=EXACTLY_ONCE):
+        '''
+        Sends tokens to the port.
+
+        topic --    topic of the target port, "<net>/<place>"
+        tokens --   list of tokens to send
+        check --    type of the sending place, selects the binary codec
+        delivery -- delivery mode of the port
+        '''
+        net, place = topic.split('/', 1)
         if net in self.nets.keys(): # Net is in running simulator instance
-            net = self.nets[net]
-            place = net.place(place)
-            self.parse_tokens(place, tokens)
-            self.simul.schedule([self.simul.execute_net, net.name], self.simul.NOW)
+            self.serve_local(
+                net, self.nets[net].place(place), token_codec.encode(tokens, check, self.TOKEN_FORMATS[0]))
         elif net in self.remote_nets: # Net is in other simulator
-            self.publish(topic, '&'.join(tokens), 2)
+            self.port_publish(topic, self.encode_tokens(net, tokens, check), delivery)
         else: # Net is not yet registered
-            self.update_remote_requests(net, '&'.join(tokens), topic)
+            self.update_remote_requests(net, (tokens, check, delivery), topic)
+
+    def port_publish(self, topic, payload, delivery=EXACTLY_ONCE):
+        '''
+        Publishes encoded tokens with QoS of the delivery mode. The message
+        is appended to the pipeline and sent by its writer, unless PIPELINE
+        is turned off. Full pipeline blocks the caller or drops the message
+        by PIPELINE_POLICY.
+        '''
+        if self.pipeline is not None:
+            self.pipeline.put((topic, payload, delivery))
+        else:
+            self.send_port_messages([(topic, payload, delivery)])
+
+    def send_port_messages(self, messages):
+        '''
+        Sends list of port messages (topic, payload, delivery). Messages
+        of one port are packed into batches up to BATCH_SIZE, when its net
+        accepts them, the order of messages of every port is kept.
+        '''
+        ports = {}  # (topic, delivery) -> payloads, in order of the first message
+        for topic, payload, delivery in messages:
+            ports.setdefault((topic, delivery), []).append(payload)
+        self.publish_stats['messages'] += len(messages)
+        with self.journal.batch():  # Single write of the journal records
+            for (topic, delivery), payloads in ports.items():
+                if len(payloads) == 1 or topic.split('/', 1)[0] not in self.remote_batches:
+                    for payload in payloads:
+                        self.send_port_message(topic, payload, delivery)
+                    continue
+                batch = []
+                size = 0
+                for payload in payloads:
+                    if batch and size + len(payload) > self.BATCH_SIZE:
+                        self.send_port_message(topic, pack_batch(batch), delivery)
+                        batch = []
+                        size = 0
+                    batch.append(payload)
+                    size += len(payload)
+                self.send_port_message(topic, pack_batch(batch) if len(batch) > 1 else batch[0], delivery)
+
+    def send_port_message(self, topic, payload, delivery=EXACTLY_ONCE):
+        '''
+        Publishes the message with QoS of the delivery mode, messages
+        sent at least once are prefixed with the sequence number. Tokens
+        for receivers on the same host are written to the shared memory ring.
+        '''
+        self.publish_stats['frames'] += 1
+        qos = self.DELIVERY_QOS[delivery]
+        _, queue = self.data_connection(topic)
+        with queue.lock:
+            ring = self.rings.get(topic)
+            if ring is not None:
+                if ring.put(payload, self.RING_TIMEOUT):
+                    return
+                self.rings.pop(topic, None)     # Receiver does not read, the broker is used
+            if qos == 1:
+                payload = _sequence_header.pack(
+                    SEQUENCED, self.client_id, next(self.sequence)) + payload
+            queue.publish(topic, payload, qos)
 
     def configure(self):
+        '''
+        Registers hosted nets, negotiates their ports with other clients and
+        waits for the responses. Durations of the phases are logged
+        and kept in startup_times.
+        '''
+        start = time.perf_counter()
         self.client.user_data_set(self.nets.keys())
-        self.client._client_id = hash(str(self.nets.keys()))
+        self.client_id = hash(str(self.nets.keys()))
+        if self.JOURNAL:
+            self.recover_journal()
         # Subscribe to private messages to the MQTT client, mostly of type Update
-        self.client.subscribe(f'private/{self.client._client_id}', 2)
+        self.client.subscribe(f'private/{self.client_id}', 2)
         self.notify_others()
+        times = {'notify': time.perf_counter() - start}
+        start = time.perf_counter()
         for net in self.nets.values():
             for place in net.place():
                 if place.state == place.SEPARATED:
@@ -323,21 +1123,69 @@ class Mqtt_client():
                 elif place.state == place.OUTPUT:
                     for output_topic in place.out_topics:
                         self.output_port_setup(net, place, output_topic)
-        self.wait_net_ports()
+        times['ports'] = time.perf_counter() - start
+        start = time.perf_counter()
+        # Requests for nets registered meanwhile, the others are sent on registration
+        for net in list(self.remote_requests):
+            if net in self.remote_nets:
+                self.remote_requests_pop(net)
+        times['requests'] = time.perf_counter() - start
+        self.wait_net_ports(times)
+        self.startup_times = times
+        stats = self.request_stats
+        logging.info(
+            'Startup: ' + ', '.join(f'{phase} {duration:.3f}s' for phase, duration in times.items()) +
+            f'; {stats["requests"]} port requests in {stats["messages"]} messages, '
+            f'{stats["retries"]} retries, {sum(map(len, self.remote_requests.values()))} waiting '
+            f'for registration')
+
+    def recover_journal(self):
+        '''
+        Opens the journal of the simulator, messages left unacknowledged
+        by its previous run are sent again.
+        '''
+        recovered = self.journal.open(os.path.join('journal', f'{self.simul.id}.log'))
+        for sequence, topic, payload, qos, retain in recovered:
+            if topic == 'control' or topic.startswith(('private/', self.REGISTRY, self.SESSIONS)):
+                queue = self.outbound
+            else:
+                _, queue = self.data_connection(topic)
+            queue.publish(topic, payload, qos, retain, sequence)
+        if recovered:
+            logging.info(f'Recovered {len(recovered)} messages from the journal')
 
     def notify_others(self):
-        net_list = '&'.join(self.nets.keys())
-        net_list = f'U, update_nets, {self.client._client_id}, {net_list}'
-        self.publish('control', net_list, 2)
+        '''
+        Registers hosted nets by retained messages "registry/<net>" and the
+        session of the client by "sessions/<session>". The whole registry
+        is received by the subscriptions of "registry/#" and "sessions/#".
+        '''
+        self.client.subscribe(f'{self.SESSIONS}#', 2)
+        self.client.subscribe(f'{self.REGISTRY}#', 2)
+        self.publish(f'{self.SESSIONS}{self.session}', str(self.client_id), 1, retain=True)
+        registration = f'{self.client_id}, {self.session}, {self.formats()}'
+        for net in self.nets.keys():
+            self.publish(f'{self.REGISTRY}{net}', registration, 1, retain=True)
 
-    def wait_net_ports(self):
+    def wait_net_ports(self, times=None):
+        '''
+        Prepares hosted nets and waits until the sent port requests are answered.
+
+        times -- dictionary to store durations of the phases into
+        '''
+        times = {} if times is None else times
+        start = time.perf_counter()
         for net in self.nets.values():
             net.prepare()
-        if self.pending_req_cnt == 0:
-            return
-        with self.simul.wake_event:
-            self.simul.wake_event.wait()
+        times['prepare'] = time.perf_counter() - start
+        start = time.perf_counter()
+        with self.requests_cond:
+            self.requests_cond.wait_for(
+                lambda: not self.pending_requests or self.requests_failed or self.simul.kill)
+        times['negotiation'] = time.perf_counter() - start
 
-    def publish(self, *args, **kwargs):
-        with self.lock:
-            self.client.publish(*args, **kwargs)
+    def publish(self, topic, payload, qos=0, retain=False):
+        '''
+        Publishes the message over the control connection through its outbound queue.
+        '''
+        self.outbound.publish(topic, payload, qos, retain)
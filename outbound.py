@@ -0,0 +1,446 @@
+#!/bin/python3.7
+"""
+Outbound queues of messages published by the simulator.
+
+Every published message is written to the journal, before it is handed over
+to the client of its connection, and it is kept there, until the broker
+acknowledges it. Messages published while the connection is lost wait
+in the queue of the connection and they are sent in bulk after reconnection.
+Messages left in the journal by the simulator, which was not stopped cleanly,
+are sent again by its next run.
+
+Only messages published with QoS > 0 over the transports, which outlive
+the simulator, are written to the file, messages published at most once
+and messages of the in-process bus are kept only in memory, as they would
+not be sent again after the crash anyway.
+
+Journal is append-only file of records:
+
+    record := LENGTH TYPE SEQUENCE [QOS RETAIN TOPIC_LENGTH TOPIC PAYLOAD]
+
+LENGTH is !I length of the rest of the record, SEQUENCE is !Q number
+of the message. TYPE is P published message, followed by the message,
+or A acknowledgement of the message. TOPIC_LENGTH is !H length of the UTF-8
+topic. When the file exceeds its size, it is rewritten with unacknowledged
+messages only. Records of messages published in one batch are written
+together at its end, acknowledgements are written together with the next
+message, acknowledgement lost by the crash means the message is sent again.
+
+Pipeline decouples producers of messages from their publishing, producers
+only append to the queue, single writer thread takes all queued messages
+at once, so it may pack messages to the same peer together. The queue
+is bounded, full queue blocks the producers, or the messages are dropped
+and counted. Messages are written to the journal by the writer, those
+still waiting in the pipeline, at most its size, are lost, when the simulator
+crashes. Clean close sends them first.
+"""
+
+import os
+import time
+import struct
+import logging
+from contextlib import contextmanager
+from threading import Lock, RLock, Condition, Event, Thread, current_thread
+from collections import deque, OrderedDict
+from itertools import count
+
+PUBLISHED = b'P'
+ACKNOWLEDGED = b'A'
+
+_length = struct.Struct('!I')
+_record = struct.Struct('!cQ')
+_message = struct.Struct('!BBH')
+
+
+class Journal():
+    '''
+    Messages of the simulator, which were not acknowledged by the broker
+    yet, by their sequence numbers. Journal without the file keeps them
+    only in memory.
+    '''
+
+    def __init__(self, size=16 << 20, sync=False):
+        '''
+        size -- size of the file in bytes, which starts its rewriting
+        sync -- every record is flushed to the disk, so messages survive
+                crash of the system, not just of the simulator
+        '''
+        self.size = size
+        self.sync = sync
+        self.path = None
+        self.fd = None
+        self.bytes = 0  # Size of the file
+        self.limit = size
+        self.pending = OrderedDict()    # Sequence -> (topic, payload, qos, retain)
+        self.stored = set()     # Sequences of pending messages written to the file
+        self.buffer = bytearray()   # Records not written to the file yet
+        self.batches = 0    # Open batches, records are written at the end of the last one
+        self.sequence = count()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def open(self, path):
+        '''
+        Starts writing to the file. Returns messages left in the file
+        by the previous run as list of (sequence, topic, payload, qos, retain),
+        they are kept in the journal with new sequence numbers.
+        '''
+        recovered = []
+        if os.path.exists(path):
+            with open(path, 'rb') as journal:
+                recovered = self._read(journal.read())
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.lock:
+            self.path = path
+            recovered = [(next(self.sequence), *message) for message in recovered]
+            for sequence, *message in recovered:
+                self.pending[sequence] = tuple(message)
+                self.stored.add(sequence)
+            self._rewrite()
+        return recovered
+
+    def write(self, topic, payload, qos=0, retain=False, durable=True):
+        '''
+        Adds the message, returns its sequence number.
+
+        durable --  the message outlives the simulator in the broker,
+                    it is written to the file, when its QoS > 0
+        '''
+        with self.lock:
+            sequence = next(self.sequence)
+            self.pending[sequence] = (topic, payload, qos, retain)
+            if self.fd is not None and qos and durable:
+                self.stored.add(sequence)
+                self.buffer += self._published(sequence, topic, payload, qos, retain)
+                if not self.batches:
+                    self._flush()
+        return sequence
+
+    def message(self, sequence):
+        '''
+        Returns (topic, payload, qos, retain) of the unacknowledged message.
+        '''
+        return self.pending[sequence]
+
+    def ack(self, sequence):
+        '''
+        Removes the message acknowledged by the broker.
+        '''
+        with self.lock:
+            self.pending.pop(sequence, None)
+            if sequence not in self.stored:
+                return
+            self.stored.discard(sequence)
+            if self.bytes > self.limit:
+                self._rewrite()
+            else:
+                self.buffer += _length.pack(_record.size) + _record.pack(ACKNOWLEDGED, sequence)
+                if not self.stored and not self.batches:
+                    self._flush()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Records written in the block are written to the file by single write
+        at its end.
+        '''
+        with self.lock:
+            self.batches += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.batches -= 1
+                if not self.batches:
+                    self._flush()
+
+    def close(self):
+        '''
+        Closes the file, it is removed, when all messages were acknowledged.
+        '''
+        with self.lock:
+            if self.fd is None:
+                return
+            self._flush()
+            os.close(self.fd)
+            self.fd = None
+            if not self.stored:
+                os.remove(self.path)
+
+    def _flush(self):
+        if not self.buffer or self.fd is None:
+            return
+        os.write(self.fd, self.buffer)
+        self.bytes += len(self.buffer)
+        self.buffer = bytearray()
+        if self.sync:
+            os.fsync(self.fd)
+
+    def _rewrite(self):
+        data = b''.join(
+            self._published(sequence, *message) for sequence, message in self.pending.items()
+            if sequence in self.stored)
+        self.buffer = bytearray()   # Records of the stored messages are in the data
+        temporary = f'{self.path}.new'
+        with open(temporary, 'wb') as journal:
+            journal.write(data)
+            if self.sync:
+                journal.flush()
+                os.fsync(journal.fileno())
+        os.replace(temporary, self.path)
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.bytes = len(data)
+        self.limit = max(self.size, 2 * self.bytes)    # Journal of many pending messages is not rewritten on every ack
+
+    @staticmethod
+    def _published(sequence, topic, payload, qos, retain):
+        topic = topic.encode('utf-8')
+        body = b''.join((
+            _record.pack(PUBLISHED, sequence), _message.pack(qos, retain, len(topic)), topic, payload))
+        return _length.pack(len(body)) + body
+
+    @staticmethod
+    def _read(data):
+        '''
+        Returns unacknowledged messages of the file as list of (topic, payload, qos, retain).
+        '''
+        messages = OrderedDict()
+        offset = 0
+        while offset + _length.size <= len(data):
+            length, = _length.unpack_from(data, offset)
+            offset += _length.size
+            end = offset + length
+            if end > len(data):
+                break   # Record was not written completely
+            kind, sequence = _record.unpack_from(data, offset)
+            if kind == ACKNOWLEDGED:
+                messages.pop(sequence, None)
+            else:
+                qos, retain, size = _message.unpack_from(data, offset + _record.size)
+                start = offset + _record.size + _message.size
+                topic = data[start:start + size].decode('utf-8')
+                messages[sequence] = (topic, data[start + size:end], qos, bool(retain))
+            offset = end
+        return list(messages.values())
+
+
+class OutboundQueue():
+    '''
+    Messages published over one connection. They are handed over
+    to the client while it is connected, otherwise they wait in the queue,
+    until on_connect of the client calls flush.
+
+    Callbacks on_publish and on_disconnect of the client are methods
+    of the queue.
+    '''
+
+    def __init__(self, client, journal, resends=False, durable=True):
+        '''
+        client --   client of the connection
+        journal --  Journal shared by the queues of the simulator
+        resends --  client sends unacknowledged messages with QoS > 0 again
+                    after reconnection by itself, see transport.resends
+        durable --  messages of the client outlive the simulator, so they
+                    are written to the journal file, see transport.durable
+        '''
+        self.client = client
+        self.journal = journal
+        self.resends = resends
+        self.durable = durable
+        self.lock = RLock()     # Publishing lock of the connection
+        self.state = Condition(Lock())  # Guards the sequences below, never held while publishing
+        self.queued = deque()   # Sequences of messages waiting for the connection
+        self.inflight = {}      # Message ID of the client -> sequence
+        self.acknowledged = set()   # Message IDs acknowledged before publish returned
+        self.connected = False
+        self.connections = 0    # Established connections, more than one after reconnection
+
+    def __len__(self):
+        with self.state:
+            return len(self.queued) + len(self.inflight)
+
+    def publish(self, topic, payload, qos=0, retain=False, sequence=None):
+        '''
+        Writes the message to the journal and sends it, or queues it,
+        when the connection is lost.
+
+        sequence -- sequence number of the message, which is in the journal already
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            if sequence is None:
+                sequence = self.journal.write(topic, payload, qos, retain, self.durable)
+            with self.state:
+                if not self.connected or self.queued:
+                    self.queued.append(sequence)
+                    return
+            self._hand_over(sequence, topic, payload, qos, retain)
+
+    def flush(self):
+        '''
+        Marks the client connected and sends all queued messages in order
+        of publishing.
+        '''
+        with self.lock:
+            with self.state:
+                self.connected = True
+                self.connections += 1
+                queued = self.queued
+                self.queued = deque()
+            while queued:
+                sequence = queued.popleft()
+                if not self._hand_over(sequence, *self.journal.message(sequence)):
+                    with self.state:    # Connection was lost again
+                        self.queued = deque(sorted(self.queued + queued))
+                    return
+
+    def on_publish(self, client, userdata, mid):
+        with self.state:
+            sequence = self.inflight.pop(mid, None)
+            if sequence is None:
+                self.acknowledged.add(mid)
+                return
+            if not self.inflight and not self.queued:
+                self.state.notify_all()
+        self.journal.ack(sequence)
+
+    def on_disconnect(self, client, userdata, rc):
+        '''
+        Returns messages, which will not be sent by the client again, to the queue.
+        '''
+        with self.state:
+            self.connected = False
+            returned = [sequence for mid, sequence in self.inflight.items()
+                        if not (self.resends and self.journal.message(sequence)[2])]
+            for mid in [mid for mid, sequence in self.inflight.items() if sequence in returned]:
+                del self.inflight[mid]
+            self.queued = deque(sorted(self.queued + deque(returned)))
+
+    def join(self, timeout=None):
+        '''
+        Waits until all messages are acknowledged, returns False on timeout.
+        '''
+        with self.state:
+            return self.state.wait_for(lambda: not self.queued and not self.inflight, timeout)
+
+    def _hand_over(self, sequence, topic, payload, qos, retain):
+        '''
+        Publishes the message by the client, returns False, when the message
+        was queued, as the connection is lost.
+        '''
+        info = self.client.publish(topic, payload, qos, retain)
+        with self.state:
+            if info.rc == 0 or (qos and self.resends):  # Client keeps the message with QoS > 0
+                if info.mid not in self.acknowledged:
+                    self.inflight[info.mid] = sequence
+                    return True
+                self.acknowledged.discard(info.mid)
+            else:
+                self.connected = False
+                self.queued.append(sequence)
+                return False
+        self.journal.ack(sequence)
+        return True
+
+
+class Pipeline():
+    '''
+    Messages appended by producers without locking and written by single
+    writer thread. The writer waits for the linger window after the first
+    message, then it takes all queued messages at once.
+
+    When the pipeline is full, the policy decides what happens with
+    the next message:
+        block --    producer waits until the writer takes the queued messages
+        drop --     the message is dropped
+    '''
+    BLOCK = 'block'
+    DROP = 'drop'
+    POLICIES = (BLOCK, DROP)
+    IDLE_TIMEOUT = 1.0  # Longest sleep of the writer, when the wake-up was lost
+
+    def __init__(self, writer, linger=0.0, size=10000, policy=BLOCK):
+        '''
+        writer -- callback(messages) of the list of messages taken at once
+        linger -- seconds to wait for more messages after the first one
+        size --   maximum of queued messages
+        policy -- handling of the message, when the pipeline is full
+        '''
+        if not isinstance(size, int) or size < 1:
+            raise ValueError(f'Expected positive size of pipeline, got {size}')
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown pipeline policy "{policy}", choose from: {", ".join(self.POLICIES)}')
+        self.writer = writer
+        self.linger = linger
+        self.size = size
+        self.policy = policy
+        self.messages = deque()     # Appending and popping is atomic
+        self.idle = False
+        self.wake = Event()
+        self.space = Event()    # Set by the writer, when it took the queued messages
+        self.dropped = 0
+        self.blocked = 0    # Messages, which waited for the space
+        self.stats_lock = Lock()
+        self.closed = False
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message):
+        '''
+        Appends the message, returns False, when it was dropped.
+        '''
+        if len(self.messages) >= self.size and not self.closed:
+            if self.policy == self.DROP:
+                with self.stats_lock:
+                    self.dropped += 1
+                return False
+            with self.stats_lock:
+                self.blocked += 1
+            while len(self.messages) >= self.size and not self.closed:
+                self.space.clear()
+                self.wake.set()
+                if len(self.messages) >= self.size:     # Writer may have taken them before clear
+                    self.space.wait(self.IDLE_TIMEOUT)
+        self.messages.append(message)
+        if self.idle:   # Writer sets idle before it checks the queue for the last time
+            self.wake.set()
+        return True
+
+    def run(self):
+        while self.messages or not self.closed:
+            if not self.messages:
+                self.idle = True
+                if not self.messages and not self.closed:
+                    self.wake.wait(self.IDLE_TIMEOUT)
+                self.idle = False
+                self.wake.clear()
+                continue
+            if self.linger:
+                time.sleep(self.linger)
+            messages = []
+            while self.messages:
+                messages.append(self.messages.popleft())
+            self.space.set()
+            try:
+                self.writer(messages)
+            except Exception:
+                logging.exception(f'Writing of {len(messages)} messages failed')
+
+    def close(self):
+        '''
+        Stops the writer, once it writes all queued messages.
+        '''
+        self.closed = True
+        self.wake.set()
+        self.space.set()
+        if current_thread() is not self.thread:
+            self.thread.join()
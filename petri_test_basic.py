@@ -190,8 +190,8 @@ def execute(net_t=1):
                 if node.is_alive():
                     node.wake()
             print('done')
-        print(sim._running_events)
-        print(sim2._running_events)
+        print(sim.executor.busy())
+        print(sim2.executor.busy())
         for name, net in sim._nets.items():
             net.draw(f'nets_png/{name}.png')
 
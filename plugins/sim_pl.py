@@ -1,15 +1,417 @@
+import ast
+import keyword
+import logging
+import snakes.data
 import snakes.nets
 import snakes.plugins
 
+
+class TransitionCompiler():
+    """
+    Generates specialized Python code for the firing of a transition.
+
+    The generated function enumerates bindings of the input arcs in nested loops,
+    evaluates the guard and the output arcs in place and fires the first mode
+    in order of Transition.sorted_modes. It returns the fired binding or None.
+    Input arcs sharing a variable with the previous arcs, directly or by
+    an equality in the guard, look up matching tokens in Place.token_index.
+    Only Variable, Value, Tuple and Expression labels are supported, ValueError
+    with the reason is raised for other transitions.
+
+    Arcs are bound in order chosen on every firing by plan, code for each
+    order is generated on its first use.
+    """
+    PREFIX = '_pn_'
+
+    def __init__(self, module, joins=True, reorder=True):
+        """
+        module --  module with SNAKES classes
+        joins --   input arcs sharing a variable, directly or by an equality
+                   in the guard, are joined on indexes of the place tokens
+                   instead of iterating the whole place
+        reorder -- input arcs are bound in order given by plan,
+                   in order of declaration otherwise
+        """
+        self.module = module
+        self.joins = joins
+        self.reorder = reorder
+
+    def compile(self, transition):
+        """
+        Returns the firing function of the transition.
+
+        transition -- transition to compile, should be attached to a net
+        """
+        self.transition = transition
+        self.inputs = transition.input()
+        self.outputs = transition.output()
+        if not self.inputs:
+            # Transitions without input arcs have no modes
+            return lambda: None
+        self.equal = self._guard_equalities(transition.guard)
+        self.arc_vars = [self._vars(label) for _, label in self.inputs]
+        self.decl_vars = []     # Variables in order of Substitution.items
+        for names in self.arc_vars:
+            self.decl_vars += [n for n in names if n not in self.decl_vars]
+        self.guard_vars = self._guard_vars(transition.guard)
+        self.variants = {}
+        # Generated eagerly to find unsupported transitions on compile
+        order = tuple(range(len(self.inputs)))
+        self.variants[order] = self.generate(order)
+        if len(self.inputs) == 1 or not self.reorder:
+            return self.variants[order]
+
+        places = [place for place, _ in self.inputs]
+        def fire():
+            for place in places:
+                if not place.tokens.size():
+                    # No mode can be found with an empty input place
+                    return None
+            order = self.plan()
+            variant = self.variants.get(order)
+            if variant is None:
+                variant = self.variants[order] = self.generate(order)
+            return variant()
+        return fire
+
+    def plan(self):
+        """
+        Returns order of input arcs for binding. Arcs with values go first,
+        then arcs joined to the variables bound so far and then the others,
+        arcs of smaller places go first in each class.
+        """
+        remaining = list(range(len(self.inputs)))
+        bound = set()
+        order = []
+        while remaining:
+            arc = min(remaining, key=lambda i: self._cost(i, bound))
+            remaining.remove(arc)
+            order.append(arc)
+            bound.update(self.arc_vars[arc])
+        return tuple(order)
+
+    def _cost(self, i, bound):
+        place, label = self.inputs[i]
+        if type(label) is self.module.Value:
+            return (0, 0, i)
+        for name in self.arc_vars[i]:
+            if name in bound or any(o in bound for o in self.equal.get(name, ())):
+                return (1, place.tokens.size(), i)
+        return (2, place.tokens.size(), i)
+
+    def generate(self, order):
+        """
+        Returns the firing function binding input arcs in the order.
+        """
+        self.consts = {}
+        self.bound = []
+        self.bound_from = {}
+        self.lines = []
+        self.indent = 1
+        args = {
+            f'{self.PREFIX}t': self.transition,
+            f'{self.PREFIX}Substitution': self.module.Substitution,
+        }
+
+        consumed = [None] * len(self.inputs)
+        guard = self._guard(self.transition.guard)
+        for i in order[:-1]:
+            args[f'{self.PREFIX}p{i}'] = self.inputs[i][0]
+            consumed[i] = self._input(i, self.inputs[i][1])
+            if guard is not None and self.guard_vars.issubset(self.bound):
+                # The guard is checked as soon as all its variables are bound,
+                # failed evaluation is repeated on the complete binding to
+                # raise the error only where the interpreted path would
+                self._line('try:')
+                self._line(f'    {self.PREFIX}g = bool({guard})')
+                self._line('except Exception:')
+                self._line(f'    {self.PREFIX}g = None')
+                self._condition(f'{self.PREFIX}g is not False')
+                guard = f'{self.PREFIX}g or {guard}'
+        i = order[-1]
+        args[f'{self.PREFIX}p{i}'] = self.inputs[i][0]
+        consumed[i] = self._input(i, self.inputs[i][1])
+        self._condition(guard)
+        produced = []
+        for j, (place, label) in enumerate(self.outputs):
+            args[f'{self.PREFIX}q{j}'] = place
+            self._line(f'{self.PREFIX}o{j} = {self._output(label)}')
+            self._condition(f'{self.PREFIX}q{j}._check({self.PREFIX}o{j})')
+            produced.append(f'{self.PREFIX}o{j}')
+
+        self._line(f'{self.PREFIX}m += 1')
+        key = ', '.join(f'({name!r}, {name})' for name in self.decl_vars)
+        self._line(f'{self.PREFIX}key = [{key}]')
+        self._condition(f'{self.PREFIX}best is None or {self.PREFIX}key < {self.PREFIX}best[0]')
+        self._line(f'{self.PREFIX}best = ({self.PREFIX}key, ({"".join(c + ", " for c in consumed)}), '
+                   f'({"".join(o + ", " for o in produced)}))')
+
+        self.indent = 1
+        self._line(f'{self.PREFIX}t.candidates_examined += {self.PREFIX}n')
+        self._line(f'{self.PREFIX}t.modes_produced += {self.PREFIX}m')
+        self._line(f'if {self.PREFIX}best is None:')
+        self._line('    return None')
+        for i in range(len(self.inputs)):
+            self._line(f'{self.PREFIX}p{i}.remove([{self.PREFIX}best[1][{i}]])')
+        self._line(f'{self.PREFIX}binding = {self.PREFIX}Substitution({self.PREFIX}best[0])')
+        self._line(f'if {self.PREFIX}t.extension:')
+        self._line(f'    {self.PREFIX}t.extension.check_and_fire({self.PREFIX}binding)')
+        if self.outputs:
+            self._line('else:')
+            for j in range(len(self.outputs)):
+                self._line(f'    {self.PREFIX}q{j}.add([{self.PREFIX}best[2][{j}]])')
+        self._line(f'return {self.PREFIX}binding')
+
+        args.update(self.consts)
+        source = '\n'.join(
+            [f'def {self.PREFIX}factory({", ".join(args)}):',
+             f'    def {self.PREFIX}fire():',
+             f'        {self.PREFIX}best = None',
+             f'        {self.PREFIX}n = {self.PREFIX}m = 0']
+            + ['    ' + line for line in self.lines]
+            + [f'    return {self.PREFIX}fire'])
+        factory = {}
+        code = compile(source, f'<transition {self.transition.name}>', 'exec')
+        exec(code, self.transition.net.globals._env, factory)
+        return factory[f'{self.PREFIX}factory'](**args)
+
+    def _line(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def _condition(self, cond):
+        if cond is not None:
+            self._line(f'if {cond}:')
+            self.indent += 1
+
+    def _const(self, value):
+        name = f'{self.PREFIX}k{len(self.consts)}'
+        self.consts[name] = value
+        return name
+
+    def _input(self, i, label):
+        """
+        Generates loops binding the input arc, returns the consumed token.
+        """
+        self.arc = i
+        if type(label) is self.module.Value:
+            token = self._const(label.value)
+            self._condition(f'{token} in {self.PREFIX}p{i}.tokens')
+            return token
+        token = f'{self.PREFIX}v{i}'
+        if type(label) not in (self.module.Variable, self.module.Tuple):
+            raise ValueError(f'unsupported input arc {label!r}')
+        join = self._join(label, ()) if self.joins else None
+        if join is None:
+            self._line(f'for {token} in {self.PREFIX}p{i}.tokens.keys():')
+        else:
+            path, var = join
+            self._line(f'for {token} in {self.PREFIX}p{i}.token_index({self._const(path)})'
+                       f'.get({var}, ()):')
+        self.indent += 1
+        self._line(f'{self.PREFIX}n += 1')
+        self._match(token, label)
+        return token
+
+    def _vars(self, label):
+        """
+        Returns variables of the input arc in order of binding.
+        """
+        if type(label) is self.module.Variable:
+            return [label.name]
+        elif type(label) is self.module.Value:
+            return []
+        elif type(label) is self.module.Tuple:
+            return [n for c in label._components for n in self._vars(c)]
+        raise ValueError(f'unsupported input arc {label!r}')
+
+    def _match(self, value, label):
+        if type(label) is self.module.Variable:
+            self._bind(label.name, value)
+        elif type(label) is self.module.Value:
+            self._condition(f'{value} == {self._const(label.value)}')
+        elif type(label) is self.module.Tuple:
+            size = len(label._components)
+            self._condition(f'isinstance({value}, tuple) and len({value}) == {size}')
+            for k, comp in enumerate(label._components):
+                self._match(f'{value}[{k}]', comp)
+        else:
+            raise ValueError(f'unsupported input arc {label!r}')
+
+    def _join(self, label, path):
+        """
+        Returns path to a component of the arc and a bound variable, which
+        the component should be equal to, or None if there is no such component.
+        """
+        if type(label) is self.module.Variable:
+            if label.name in self.bound:
+                return path, label.name
+            for other in self.equal.get(label.name, ()):
+                if other in self.bound:
+                    return path, other
+        elif type(label) is self.module.Tuple:
+            size = len(label._components)
+            for pos, comp in enumerate(label._components):
+                join = self._join(comp, path + ((pos, size),))
+                if join is not None:
+                    return join
+        return None
+
+    def _guard_equalities(self, guard):
+        """
+        Maps variables to variables, which are required to be equal by
+        the guard, i.e. compared by == in a conjunction on its top level.
+        """
+        equal = {}
+        if type(guard) is not self.module.Expression or guard._true:
+            return equal
+        try:
+            tree = ast.parse(guard._str, mode='eval').body
+        except SyntaxError:
+            return equal
+        conds = tree.values if isinstance(tree, ast.BoolOp) \
+            and isinstance(tree.op, ast.And) else [tree]
+        for cond in conds:
+            if isinstance(cond, ast.Compare) and len(cond.ops) == 1 \
+                    and isinstance(cond.ops[0], ast.Eq) \
+                    and isinstance(cond.left, ast.Name) \
+                    and isinstance(cond.comparators[0], ast.Name):
+                left, right = cond.left.id, cond.comparators[0].id
+                equal.setdefault(left, []).append(right)
+                equal.setdefault(right, []).append(left)
+        return equal
+
+    def _guard_vars(self, guard):
+        """
+        Returns variables of the input arcs used in the guard.
+        """
+        if type(guard) is not self.module.Expression or guard._true:
+            return set()
+        tree = ast.parse(guard._str, mode='eval')
+        names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+        return names.intersection(self.decl_vars)
+
+    def _bind(self, name, value):
+        if not name.isidentifier() or keyword.iskeyword(name) \
+                or name.startswith(self.PREFIX):
+            raise ValueError(f'unsupported variable name {name!r}')
+        if name in self.bound:
+            self._condition(f'{name} == {value}')
+            # Consistent with Substitution.__add__, the value is taken from the
+            # last arc in order of declaration
+            if self.arc < self.bound_from[name]:
+                return
+        else:
+            self.bound.append(name)
+        self.bound_from[name] = self.arc
+        self._line(f'{name} = {value}')
+
+    def _guard(self, guard):
+        if type(guard) is not self.module.Expression:
+            raise ValueError(f'unsupported guard {guard!r}')
+        if guard._true:
+            return None
+        return self._expression(guard)
+
+    def _expression(self, expr):
+        if expr._true:
+            return 'True'
+        if '__binding__' in expr._str or self.PREFIX in expr._str:
+            raise ValueError(f'unsupported expression {expr!r}')
+        return f'({expr._str})'
+
+    def _output(self, label):
+        if type(label) is self.module.Variable:
+            if label.name not in self.bound:
+                raise ValueError(f'unbound variable {label.name!r}')
+            return label.name
+        elif type(label) is self.module.Value:
+            return self._const(label.value)
+        elif type(label) is self.module.Expression:
+            return self._expression(label)
+        elif type(label) is self.module.Tuple:
+            return f'({"".join(self._output(c) + ", " for c in label._components)})'
+        raise ValueError(f'unsupported output arc {label!r}')
+
 @snakes.plugins.plugin("snakes.nets")
 def extend(module):
     class PetriNet(module.PetriNet):
-        def __init__(self, name, simul=None):
+        def __init__(self, name, simul=None, compiled=True):
+            """
+            name --     name of the net
+            simul --    simulator running the net
+            compiled -- transitions are compiled to specialized code
+                        on prepare, interpreted otherwise
+            """
             self.mqtt_cl = None
+            self.compiled = compiled
             self.simul = simul
             self.ready = False
+            self.structure_version = 0  # Bumped on every change of nodes or arcs
+            self._groups = None
+            self._groups_version = None
             module.PetriNet.__init__(self, name)
 
+        def structure_changed(self):
+            """
+            Invalidates caches built upon the net structure.
+            """
+            self.structure_version += 1
+
+        def add_place(self, place, **options):
+            module.PetriNet.add_place(self, place, **options)
+            self.structure_changed()
+
+        def remove_place(self, name, **options):
+            module.PetriNet.remove_place(self, name, **options)
+            self.structure_changed()
+
+        def add_transition(self, trans, **options):
+            module.PetriNet.add_transition(self, trans, **options)
+            trans.net = self
+            self.structure_changed()
+
+        def remove_transition(self, name, **options):
+            module.PetriNet.remove_transition(self, name, **options)
+            self.structure_changed()
+
+        def modes_cache_stats(self):
+            """
+            Returns total hits and misses of the transition modes caches.
+            """
+            hits = sum(t.modes_hits for t in self.transition())
+            misses = sum(t.modes_misses for t in self.transition())
+            return hits, misses
+
+        def binding_stats(self):
+            """
+            Returns total candidates examined and modes produced by bindings
+            of the compiled transitions.
+            """
+            examined = sum(t.candidates_examined for t in self.transition())
+            produced = sum(t.modes_produced for t in self.transition())
+            return examined, produced
+
+        def transition_groups(self):
+            """
+            Returns transitions sorted to groups under their priority and hash,
+            group of the highest priority goes first.
+
+            Layout is computed once and kept until the net structure changes.
+            """
+            if self._groups_version == self.structure_version:
+                return self._groups
+            t_list = self.transition()
+            t_list.sort(key=lambda x: x.__hash__())
+
+            prior_tr_sort = {}
+            for t in t_list:
+                pr = t.priority() # Extracts priority from transition
+                prior_tr_sort.setdefault(pr, []).append(t)
+
+            self._groups = [prior_tr_sort[k] for k in sorted(prior_tr_sort, reverse=True)]
+            self._groups_version = self.structure_version
+            return self._groups
+
         def add_simulator(self, simul):
             self.simul = simul
             self.simul.add_petri_net(self)
@@ -20,24 +422,20 @@ def extend(module):
             output_ports = [
                 place for place in self.place() if place.state == Place.OUTPUT]
             for place in output_ports:
-                tokens = []
                 if not place.tokens:
                     continue
-                tokens = self.prepare_tokens(place.tokens)
+                tokens = list(place.tokens)
                 for topic in place.out_topics:
-                    self.mqtt_cl.topic_publish(topic, tokens)
+                    target = place.local_targets.get(topic)
+                    if target is None:
+                        self.mqtt_cl.topic_publish(
+                            topic, tokens, place.checker(), place.delivery_mode(topic))
+                        continue
+                    # Target net is in this simulator, tokens are queued as they are
+                    net, target_place = target
+                    self.mqtt_cl.serve_local(net, target_place, list(tokens))
                 place.empty()
 
-        def prepare_tokens(self, tokens):
-            result = []
-            for token in tokens:
-                if isinstance(token, (tuple, list, set)):
-                    result.append(
-                        f'{token.__class__.__name__}:{self.prepare_tokens(token)}')
-                else:
-                    result.append(f'{token.__class__.__name__}:{token}')
-            return result
-
         def prepare(self):
             if self.ready:
                 return
@@ -45,19 +443,40 @@ def extend(module):
                 tr._add_parent_net(self)
                 tr._add_simulator(self.simul)
                 tr.prepare()
+                if self.compiled:
+                    tr.compile()
+            self.transition_groups()
             self.ready = True
 
-        def add_remote_output(self, place, target):
+        def add_remote_output(self, place, target, delivery=None):
+            """
+            Sends tokens of the place to the port of other net.
+
+            place --    output place or its name
+            target --   topic of the target port, "<net>/<place>"
+            delivery -- delivery mode of the tokens, one of Place.DELIVERY_MODES,
+                        exactly once by default
+            """
             if isinstance(place, str):
                 place = self.place(place)
             place.set_place_type(place.OUTPUT)
             place.add_output_topic(target)
+            place.set_delivery(target, delivery or place.EXACTLY_ONCE)
 
-        def add_remote_input(self, place, target):
+        def add_remote_input(self, place, target, delivery=None):
+            """
+            Receives tokens from the port of other net into the place.
+
+            place --    input place or its name
+            target --   topic of the source port, "<net>/<place>"
+            delivery -- delivery mode of the tokens, one of Place.DELIVERY_MODES,
+                        exactly once by default
+            """
             if isinstance(place, str):
                 place = self.place(place)
             place.set_place_type(place.INPUT)
             place.add_input_topic(target)
+            place.set_delivery(target, delivery or place.EXACTLY_ONCE)
 
         def draw(self, filename, engine="dot", debug=False,
                     graph_attr=None, cluster_attr=None,
@@ -68,6 +487,92 @@ def extend(module):
                     place_attr=Place.draw_place, trans_attr=Transition.draw_transition, arc_attr=None)
 
     class Transition(module.Transition):
+        MODES_CACHE_LIMIT = 4096    # Longer lists of modes are not cached
+        HASH_JOINS = True           # Compiled transitions join input arcs on indexes
+        REORDER_ARCS = True         # Compiled transitions bind smaller places first
+
+        def __init__(self, name, guard=None, **args):
+            self._modes_key = None
+            self._modes = None
+            self._arcs_version = 0
+            self.modes_hits = 0
+            self.modes_misses = 0
+            self.compiled = None        # Specialized firing function
+            self.candidates_examined = 0    # Tokens examined by compiled bindings
+            self.modes_produced = 0         # Modes found by compiled bindings
+            module.Transition.__init__(self, name, guard, **args)
+
+        def compile(self):
+            """
+            Compiles the firing of the transition to specialized code. Transitions
+            which cannot be compiled are left to the interpreted path.
+            """
+            try:
+                compiler = TransitionCompiler(module, self.HASH_JOINS, self.REORDER_ARCS)
+                self.compiled = compiler.compile(self)
+            except (ValueError, SyntaxError) as e:
+                logging.info(f'Transition "{self.name}" is interpreted: {e}')
+                self.compiled = None
+
+        def fire_first(self):
+            """
+            Fires the first enabled mode from sorted_modes.
+            Returns the binding used or None, when the transition is not enabled.
+            """
+            if self.compiled is not None:
+                return self.compiled()
+            for m in self.sorted_modes():
+                if self.enabled(m):
+                    self.fire(m)
+                    return m
+            return None
+
+        def sorted_modes(self):
+            """
+            Returns modes of the transition, sorted to preserve the order
+            in repeatable execution. The list should not be modified.
+
+            Modes are cached until any of the input places changes,
+            the cache is keyed on versions of the input places.
+            """
+            key = (self._arcs_version,) + tuple(
+                place.version for place, _ in self.input())
+            if key == self._modes_key:
+                self.modes_hits += 1
+                return self._modes
+            self.modes_misses += 1
+            modes = self.modes()
+            modes.sort(key=lambda x: x.items())
+            if len(modes) <= self.MODES_CACHE_LIMIT:
+                self._modes_key, self._modes = key, modes
+            else:
+                self._modes_key, self._modes = None, None
+            return modes
+
+        def add_input(self, place, label):
+            module.Transition.add_input(self, place, label)
+            self._structure_changed()
+
+        def remove_input(self, place):
+            module.Transition.remove_input(self, place)
+            self._structure_changed()
+
+        def add_output(self, place, label):
+            module.Transition.add_output(self, place, label)
+            self._structure_changed()
+
+        def remove_output(self, place):
+            module.Transition.remove_output(self, place)
+            self._structure_changed()
+
+        def _structure_changed(self):
+            self._arcs_version += 1
+            if self.compiled is not None:
+                self.compile()
+            net = getattr(self, 'net', None)
+            if net is not None:
+                net.structure_changed()
+
         @staticmethod
         def draw_transition(trans, attr):
             if trans.extension:
@@ -77,12 +582,86 @@ def extend(module):
         SEPARATED = 1
         INPUT = 2
         OUTPUT = 3
+        AT_MOST_ONCE = 'at_most_once'
+        AT_LEAST_ONCE = 'at_least_once'     # Duplicates are dropped by the receiver
+        EXACTLY_ONCE = 'exactly_once'
+        DELIVERY_MODES = (AT_MOST_ONCE, AT_LEAST_ONCE, EXACTLY_ONCE)   # From the weakest
         def __init__(self, name, tokens=[], check=None):
             self.state = Place.SEPARATED
             self.inp_topics = []
             self.out_topics = []
+            self.delivery = {}  # Delivery mode by topic of the port
+            self.local_targets = {}     # Net name and place by output topic of local nets
+            self.version = 0    # Bumped on every change of tokens
+            self._indexes = {}
             module.Place.__init__(self, name, tokens, check)
 
+        def add(self, tokens):
+            module.Place.add(self, tokens)
+            self.version += 1
+            for path, index in self._indexes.items():
+                for token in snakes.data.iterate(tokens):
+                    self._index_token(index, path, token)
+
+        def remove(self, tokens):
+            module.Place.remove(self, tokens)
+            self.version += 1
+            for path, index in self._indexes.items():
+                for token in snakes.data.iterate(tokens):
+                    if token in self.tokens:
+                        continue
+                    try:
+                        key = self._token_key(token, path)
+                    except LookupError:
+                        continue
+                    group = index.get(key)
+                    if group is not None:
+                        group.pop(token, None)
+                        if not group:
+                            del index[key]
+
+        def empty(self):
+            module.Place.empty(self)
+            self.version += 1
+            self._indexes = {}
+
+        def reset(self, tokens):
+            module.Place.reset(self, tokens)
+            self.version += 1
+            self._indexes = {}
+
+        def token_index(self, path):
+            """
+            Returns distinct tokens grouped by their component, the index is
+            built on the first call and then maintained on every change.
+
+            path -- sequence of pairs (position, tuple size), leading
+                    to the component in nested tuple tokens, tokens
+                    of other structure are not indexed
+            """
+            index = self._indexes.get(path)
+            if index is None:
+                index = {}
+                for token in self.tokens.keys():
+                    self._index_token(index, path, token)
+                self._indexes[path] = index
+            return index
+
+        @staticmethod
+        def _token_key(token, path):
+            for pos, size in path:
+                if not isinstance(token, tuple) or len(token) != size:
+                    raise LookupError(f'Token {token} does not match the index')
+                token = token[pos]
+            return token
+
+        def _index_token(self, index, path, token):
+            try:
+                key = self._token_key(token, path)
+            except LookupError:
+                return
+            index.setdefault(key, {})[token] = None
+
         def set_place_type(self, p_type):
             if self.state == self.SEPARATED:
                 self.state = p_type
@@ -98,6 +677,28 @@ def extend(module):
             if out_topic not in self.out_topics:
                 self.out_topics.append(out_topic)
 
+        def set_delivery(self, topic, mode):
+            """
+            Sets delivery mode of the tokens sent through the port topic,
+            the stronger one is kept, when the mode was already set.
+            """
+            if mode not in self.DELIVERY_MODES:
+                raise ValueError(
+                    f'Unknown delivery mode "{mode}", choose from: {", ".join(self.DELIVERY_MODES)}')
+            current = self.delivery.get(topic, mode)
+            self.delivery[topic] = max(current, mode, key=self.DELIVERY_MODES.index)
+
+        def delivery_mode(self, topic=None):
+            """
+            Returns delivery mode of the port topic, or the strongest mode of
+            all topics, when no topic is specified. Exactly once by default.
+            """
+            if topic is not None:
+                return self.delivery.get(topic, self.EXACTLY_ONCE)
+            if not self.delivery:
+                return self.EXACTLY_ONCE
+            return max(self.delivery.values(), key=self.DELIVERY_MODES.index)
+
         @staticmethod
         def draw_place (place, attr) :
             if place.state == Place.SEPARATED:
@@ -111,4 +712,4 @@ def extend(module):
                 attr['color'] = '#FF0000'
                 attr['label'] = f"Sending to: \\n{topics}\\n{attr['label']}"
 
-    return PetriNet, Place
+    return PetriNet, Transition, Place
@@ -119,7 +119,7 @@ def room_timetable(room_name, timetable):
     n.add_place(new_exp)
     n.add_place(exp_temp)
 
-    n.add_remote_input(time_up, 'weather-generator/Time update')
+    n.add_remote_input(time_up, 'weather-generator/Time update', delivery=Place.AT_LEAST_ONCE)
     n.add_remote_output(temp_up, f'{room_name}-sensors/Table update')
 
     skip_tmp = Transition('Skip change', guard=Expression('Tnew == Told'), prior=1)
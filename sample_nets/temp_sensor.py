@@ -35,7 +35,7 @@ def room_sens(room_name, exp_temp):
     n.add_transition(up_exp)
 
     n.add_remote_input(
-        temp_ins, f'{room_name}-temperature-updater/Inside update')
+        temp_ins, f'{room_name}-temperature-updater/Inside update', delivery=Place.AT_MOST_ONCE)
     n.add_remote_input(table_up, f'{room_name}-timetable/Temperature update')
     n.add_remote_output(val_st, 'boiler-logic/Sensory input')
     return n
@@ -0,0 +1,315 @@
+#!/bin/python3.7
+"""
+Single-producer single-consumer rings of port messages in shared memory,
+for simulators on one host.
+
+Ring is a file in /dev/shm mapped to the memory of both processes, the
+consumer creates it and the producer attaches to it by its path. The file
+starts with the header:
+
+    0   head --     =Q bytes written by the producer
+    64  tail --     =Q bytes read by the consumer
+    128 waiting --  =I consumer is going to sleep, producer should wake it up
+    132 closed --   =I consumer does not read anymore
+    136 fifo --     =H length of the path of the wake-up FIFO and the path
+
+Data follow from offset DATA. Record is =I length followed by the payload,
+length WRAP, or less than 4 bytes left, marks the end of data before the end
+of the buffer. Head and tail are on separate cache lines, each of them
+is written by one side only.
+
+All rings of the consumer share one FIFO, the producer writes a byte to it,
+when the consumer is waiting. Wake-up lost in the race with going to sleep
+is caught by the timeout of the sleep.
+"""
+
+import os
+import glob
+import mmap
+import atexit
+import time
+import select
+import struct
+import tempfile
+from threading import Lock, Thread, current_thread
+from itertools import count
+
+DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+HEAD = 0
+TAIL = 64
+WAITING = 128
+CLOSED = 132
+FIFO = 136
+DATA = 512
+WRAP = 0xFFFFFFFF
+
+_index = struct.Struct('=Q')
+_flag = struct.Struct('=I')
+_length = struct.Struct('=I')
+_short = struct.Struct('=H')
+
+
+def remove_files(name, directory=DIRECTORY):
+    """
+    Removes files of the consumer of the name, which did not close its rings.
+    """
+    for path in glob.glob(os.path.join(directory, glob.escape(name)) + '[.-]*'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass    # Removed meanwhile
+
+
+class Ring():
+    '''
+    Ring buffer of payloads in the memory-mapped file, created by create
+    on the consumer side and by attach on the producer side.
+    '''
+
+    def __init__(self, path, memory):
+        self.path = path
+        self.memory = memory
+        self.capacity = len(memory) - DATA
+        self.wake_fd = None
+
+    @classmethod
+    def create(cls, path, size, fifo):
+        '''
+        path -- path of the file of the ring, it must not exist
+        size -- size of the data in bytes
+        fifo -- path of the FIFO, which wakes up the consumer
+        '''
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        try:
+            os.ftruncate(fd, DATA + size)
+            memory = mmap.mmap(fd, DATA + size)
+        finally:
+            os.close(fd)
+        fifo = fifo.encode('utf-8')
+        _short.pack_into(memory, FIFO, len(fifo))
+        memory[FIFO + _short.size:FIFO + _short.size + len(fifo)] = fifo
+        return cls(path, memory)
+
+    @classmethod
+    def attach(cls, path):
+        '''
+        Raises OSError, when the ring does not exist, e.g. the consumer
+        runs on another host.
+        '''
+        fd = os.open(path, os.O_RDWR)
+        try:
+            memory = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        ring = cls(path, memory)
+        size, = _short.unpack_from(memory, FIFO)
+        fifo = memory[FIFO + _short.size:FIFO + _short.size + size].decode('utf-8')
+        try:
+            ring.wake_fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            memory.close()
+            raise
+        return ring
+
+    def put(self, payload, timeout=1.0):
+        '''
+        Appends the payload, waits up to timeout seconds for free space.
+        Returns False, when the payload was not written, as the consumer
+        is closed or does not read.
+        '''
+        memory = self.memory
+        if _flag.unpack_from(memory, CLOSED)[0]:
+            return False
+        size = _length.size + len(payload)
+        head, = _index.unpack_from(memory, HEAD)
+        position = head % self.capacity
+        rest = self.capacity - position
+        skip = rest if rest < size else 0
+        if skip + size > self.capacity:
+            return False    # Never fits
+        deadline = None
+        while self.capacity - (head - _index.unpack_from(memory, TAIL)[0]) < skip + size:
+            if _flag.unpack_from(memory, CLOSED)[0]:
+                return False
+            if deadline is None:
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                return False
+            self.wake()
+            time.sleep(0.0005)
+        if skip:
+            if rest >= _length.size:
+                _length.pack_into(memory, DATA + position, WRAP)
+            position = 0
+        start = DATA + position
+        _length.pack_into(memory, start, len(payload))
+        memory[start + _length.size:start + size] = payload
+        _index.pack_into(memory, HEAD, head + skip + size)
+        if _flag.unpack_from(memory, WAITING)[0]:
+            self.wake()
+        return True
+
+    def wake(self):
+        try:
+            os.write(self.wake_fd, b'\x00')
+        except (BlockingIOError, BrokenPipeError):
+            pass    # Consumer is woken up already, or it is gone
+
+    def take(self):
+        '''
+        Removes and returns all written payloads.
+        '''
+        memory = self.memory
+        head, = _index.unpack_from(memory, HEAD)
+        tail, = _index.unpack_from(memory, TAIL)
+        payloads = []
+        while tail < head:
+            position = tail % self.capacity
+            rest = self.capacity - position
+            if rest < _length.size:
+                tail += rest
+                continue
+            length, = _length.unpack_from(memory, DATA + position)
+            if length == WRAP:
+                tail += rest
+                continue
+            start = DATA + position + _length.size
+            payloads.append(memory[start:start + length])
+            tail += _length.size + length
+        _index.pack_into(memory, TAIL, tail)
+        return payloads
+
+    def set_waiting(self, waiting):
+        _flag.pack_into(self.memory, WAITING, int(waiting))
+
+    def close(self):
+        '''
+        Closes the ring, the consumer removes its file too.
+        '''
+        if self.wake_fd is None:
+            _flag.pack_into(self.memory, CLOSED, 1)
+            os.remove(self.path)
+        else:
+            os.close(self.wake_fd)
+        self.memory.close()
+
+
+class RingReader():
+    '''
+    Creates rings of the consumer and reads them by a single thread.
+    Every producer of the topic has one ring, it is created by the first
+    request and removed together with the producer.
+    '''
+    WAKE_TIMEOUT = 0.1  # Longest sleep, when the wake-up was lost
+
+    def __init__(self, handler, name, directory=DIRECTORY):
+        '''
+        handler --      callback(topic, payload) of the read payloads
+        name --         unique name of the consumer, prefix of its files
+        directory --    directory of the files
+        '''
+        self.handler = handler
+        self.prefix = os.path.join(directory, name)
+        self.fifo = f'{self.prefix}.wake'
+        os.mkfifo(self.fifo, 0o600)
+        self.fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        self.rings = []     # (topic, ring), replaced on change, so it is read without lock
+        self.keys = {}      # (topic, producer) -> ring
+        self.retired = []   # Removed rings, closed by the reading thread
+        self.names = count()
+        self.lock = Lock()
+        self.closed = False
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)     # Files are removed, even if the consumer is not closed
+
+    def create(self, topic, size=1 << 20, producer=None):
+        '''
+        Creates the ring for messages of the topic from the producer,
+        returns its path, the path of the existing ring, when it was
+        created already.
+        '''
+        with self.lock:
+            ring = self.keys.get((topic, producer))
+            if ring is not None:
+                return ring.path
+            path = f'{self.prefix}-{next(self.names)}.ring'
+            ring = Ring.create(path, size, self.fifo)
+            self.keys[(topic, producer)] = ring
+            self.rings = self.rings + [(topic, ring)]
+        return path
+
+    def remove(self, topic=None, producer=None):
+        '''
+        Removes rings of the topic, or of the producer, or both. Their files
+        are removed by the reading thread, once it reads the rest of them.
+        Returns number of removed rings.
+        '''
+        with self.lock:
+            keys = [key for key in self.keys
+                    if topic in (None, key[0]) and producer in (None, key[1])]
+            removed = [self.keys.pop(key) for key in keys]
+            if not removed:
+                return 0
+            self.rings = [(t, ring) for t, ring in self.rings if all(ring is not r for r in removed)]
+            self.retired += [(key[0], ring) for key, ring in zip(keys, removed)]
+        os.write(self.fd, b'\x00')
+        return len(removed)
+
+    def run(self):
+        while not self.closed:
+            if self.retired:
+                self.retire()
+            if self.drain():
+                continue
+            rings = self.rings
+            for _, ring in rings:
+                ring.set_waiting(True)
+            if not self.drain():
+                select.select([self.fd], [], [], self.WAKE_TIMEOUT)
+            for _, ring in rings:
+                ring.set_waiting(False)
+            try:
+                os.read(self.fd, 4096)
+            except BlockingIOError:
+                pass
+
+    def drain(self, rings=None):
+        read = False
+        for topic, ring in self.rings if rings is None else rings:
+            for payload in ring.take():
+                self.handler(topic, payload)
+                read = True
+        return read
+
+    def retire(self):
+        '''
+        Reads the rest of removed rings and closes them.
+        '''
+        with self.lock:
+            retired, self.retired = self.retired, []
+        self.drain(retired)
+        for _, ring in retired:
+            ring.close()
+
+    def close(self):
+        '''
+        Stops reading and removes files of the rings.
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        atexit.unregister(self.close)
+        os.write(self.fd, b'\x00')
+        if current_thread() is not self.thread:
+            self.thread.join()
+        with self.lock:
+            for _, ring in self.rings + self.retired:
+                ring.close()
+            self.rings = []
+            self.retired = []
+            self.keys = {}
+        os.close(self.fd)
+        os.remove(self.fifo)
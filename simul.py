@@ -5,7 +5,10 @@ import signal
 import random
 import os
 import sys
+import math
 from threading import Condition, Thread, RLock
+from collections import deque
+from itertools import count
 
 from heapq import *
 from mqtt_client import Mqtt_client
@@ -26,27 +29,54 @@ class PNSim(Thread):
     barier = None
     wake_event = Condition()
 
-    def __init__(self, *, broker="127.0.0.1", simul_id=None, detached=True, debug=True):
+    def __init__(self, *, broker="127.0.0.1", simul_id=None, detached=True, debug=True,
+                 workers=4, virtual=False, timer_tick=None, queue_size=None, queue_policy=None,
+                 queue_timeout=None):
         """
         Simulation main class initializer.
 
-        broker --   IP address of broker to use
+        broker --   address of broker to use, IP address of MQTT broker,
+                    "local://NAME" of in-process bus or "unix://PATH" of bus
+                    served over Unix domain socket, see transport.py.
+                    List of addresses shards port topics among the brokers,
+                    the first one carries control messages, see Mqtt_client
         simul_id -- The name of the simulation instance. Is used for unique identification.
                     If not specified, will be generated from expression sim_run-<rand(0,10000)>.
         detached -- boolean value, which specify if the tokens from Petri Net remote ports
                     should be stored for future sending, or will just disappear, when the
                     target remote port to send is non existing yet, which is corresponds to True.
-                    Default value is True.
+                    Stored tokens are kept in bounded buffer of the target net, see
+                    Mqtt_client.BUFFER_SIZE and BUFFER_POLICY. Default value is True.
         debug --    boolean, which specify, if every execution of Petri Net
                     will create a new drawing of it's state.
+        workers --  number of threads executing planned events. Events of one
+                    Petri Net are never executed concurrently. Default value is 4.
+        virtual --  boolean, which specify if the simulation time is driven by the
+                    planned events instead of the wall clock. Simulation jumps right
+                    to the next event, once all running events are finished.
+                    Default value is False.
+        timer_tick -- length of the tick in seconds, when specified, events are planned
+                    on the hierarchical timing wheel, which releases all events of one
+                    tick together. By default events are kept in binary heap.
+        queue_size -- maximum of received port messages waiting for execution of their nets,
+                    see Mqtt_client.PORT_QUEUE_SIZE.
+        queue_policy -- handling of received port messages, when the queue is full,
+                    "block", "drop_oldest" or "drop_newest", see mqtt_client.PortQueue.
+        queue_timeout -- seconds the receiving thread waits for space in the full queue
+                    by policy "block". Then the message sent at most once is dropped,
+                    other messages and tokens of local nets are queued over the size.
         """
         self._nets = {}
+        self._dependents = {}   # Net name -> (structure version, dependent transitions)
         self.end_time = PNSim.INF
-        self.scheduler = Scheduler()
-        self.cur_time = time.time
+        self.scheduler = Scheduler(
+            TimingWheel(timer_tick) if timer_tick else HeapQueue())
+        self.virtual = virtual
+        self._clock = 0.0   # Simulation time in virtual mode
+        self.cur_time = self._virtual_time if virtual else time.time
         self.start_time = PNSim.INF
-        self._running_events = []
-        self.mqtt = Mqtt_client(self, broker)
+        self.executor = Executor(workers)
+        self.mqtt = Mqtt_client(self, broker, queue_size, queue_policy, queue_timeout)
         self.kill = False
         self.detached = detached    # If is True, topic messages will not be stored
         self.id = self.setup_id(simul_id)
@@ -76,7 +106,10 @@ class PNSim(Thread):
     def setup(self, end_time=INF):
         assert isinstance(end_time, (int, float))
         self.mqtt.configure()
-        self.start_time = time.time()
+        logging.info(
+            f'Subscribed to {len(self.mqtt.subscriptions)} topics '
+            f'for {len(self.mqtt.routes)} input ports')
+        self.start_time = self.cur_time()
         if end_time == PNSim.INF:
             pass
         elif end_time <= 0:
@@ -90,8 +123,13 @@ class PNSim(Thread):
         if self.start_time == PNSim.INF:
             raise Exception('Simulation was not setup')
         logging.info('Starting simulation node')
+        self.executor.start()
         while not self.kill:
             while self.scheduler.next_planned():
+                if self.virtual:
+                    if self._advance_virtual_time():
+                        self._extract_and_execute()
+                    continue
                 interrupted = self._wait_to_event_begin()
                 if interrupted:   # New event arrived
                     logging.info(
@@ -104,39 +142,94 @@ class PNSim(Thread):
     def end_run(self):
         logging.info(
             f'Simulation ended at {self.cur_time() - self.start_time}')
+        logging.info(
+            f'Merged net executions: {self.scheduler.merged}')
+        queue = self.mqtt.port_queue
+        logging.info(
+            f'Port messages: {queue.high_water} queued at most, {queue.dropped} dropped, '
+            f'{queue.overflowed} over the size')
+        stats = self.mqtt.publish_stats
+        logging.info(
+            f'Published port messages: {stats["messages"]} in {stats["frames"]} frames')
+        pipeline = self.mqtt.pipeline
+        if pipeline is not None:
+            logging.info(
+                f'Publishing pipeline: {pipeline.blocked} messages waited for space, '
+                f'{pipeline.dropped} dropped')
+        reader = self.mqtt.ring_reader
+        logging.info(
+            f'Shared memory rings: {len(self.mqtt.rings)} sending, '
+            f'{len(reader.rings) if reader else 0} receiving')
+        self.executor.stop()
         if self.kill:
             self.mqtt.close()
             logging.info(f'Simulation ended')
             if self.mqtt.remote_requests:
                 logging.info(
                     f'Remote requests left unserved: {self.mqtt.remote_requests}')
+            for net, (depth, size) in self.mqtt.buffer_gauges().items():
+                logging.info(
+                    f'Tokens left unsent to "{net}": {depth} messages, {size} bytes')
+            if self.mqtt.journal.stored:
+                logging.info(
+                    f'Messages not acknowledged by the broker: {len(self.mqtt.journal.stored)}, '
+                    f'kept in the journal for the next run')
             print('Simulation interrupted')
         sys.exit()
 
     def _wait_to_event_begin(self):
         if self.kill:
             self.end_run()
-        tm = self.scheduler.next_planned()
-        logging.info('Checking event at {}'.format(
-            ((tm - self.start_time) if tm != PNSim.NOW else 'NOW')))
-        interrupted = False
-        if tm == PNSim.NOW:
-            return interrupted
-        if self.end_time != PNSim.INF \
-                and tm >= self.end_time:
-            return
-        if tm != PNSim.NOW and tm < self.cur_time():
-            sys.stderr.write(
-                "Fall back on schedule for {}s at time {}s\n".format(
-                    tm - self.cur_time(), self.cur_time() - self.start_time))
-        logging.info('Waiting for {}'.format(tm - self.cur_time()))
+        # Holding the lock from the check to the wait, so the event planned
+        # meanwhile by a running event can not slip away unnoticed
         with PNSim.wake_event:
+            tm = self.scheduler.next_planned()
+            logging.info('Checking event at {}'.format(
+                ((tm - self.start_time) if tm != PNSim.NOW else 'NOW')))
+            interrupted = False
+            if tm == PNSim.NOW:
+                return interrupted
+            if self.end_time != PNSim.INF \
+                    and tm >= self.end_time:
+                return
+            if tm != PNSim.NOW and tm < self.cur_time() - self.scheduler.resolution:
+                sys.stderr.write(
+                    "Fall back on schedule for {}s at time {}s\n".format(
+                        tm - self.cur_time(), self.cur_time() - self.start_time))
+            logging.info('Waiting for {}'.format(tm - self.cur_time()))
             if tm == PNSim.INF:
                 interrupted = PNSim.wake_event.wait()
             else:
                 interrupted = PNSim.wake_event.wait(tm - self.cur_time())
         return interrupted
 
+    def _virtual_time(self):
+        return self._clock
+
+    def _advance_virtual_time(self):
+        """
+        Moves the virtual clock to the next planned event. Running events are
+        awaited first, as they could still plan something earlier.
+
+        Returns True when the next event is due, False when there is nothing
+        left to execute. Ends the simulation, when the end time is reached.
+        """
+        if self.kill:
+            self.end_run()
+        tm = self.scheduler.next_planned()
+        if tm == PNSim.NOW or (tm is not None and tm <= self._clock):
+            return True
+        self.executor.wait_idle()
+        tm = self.scheduler.next_planned()
+        if tm is None:
+            return False
+        if tm != PNSim.NOW and tm > self._clock:
+            if tm >= self.end_time:
+                logging.info(f'Reached end time {self.end_time - self.start_time}')
+                self.end_run()
+            self._clock = tm
+        return True
+
     def _extract_and_execute(self):
         if self.kill:
             self.end_run()
@@ -151,18 +244,43 @@ class PNSim(Thread):
             logging.info('Executing {} - {}'.format(
                 (tm - self.start_time) if tm != PNSim.NOW else 'NOW',
                 action))
-            net_runner = Thread(target=function, args=args)
-            net_runner.start()
-            self._running_events.append(net_runner)
+            self.executor.submit(self._event_lane(function, args), function, args)
+
+    def _event_lane(self, function, args):
+        """
+        Returns the name of the net, which the event is working with,
+        so the events for one net are executed in order and never overlap.
+        Returns None for events not bound to any net of the simulation.
+
+        function -- planned callable
+        args --     arguments of the planned callable
+        """
+        if args and str(args[0]) in self._nets:
+            return str(args[0])
+        # Transition extensions (e.g. Timed.unblock) are bound to their net
+        transition = getattr(getattr(function, '__self__', None), 'transition', None)
+        net = getattr(transition, 'net', None)
+        if net is not None:
+            return net.name
+        return None
 
     def _wait_to_finish_or_new_event(self):
-        self._running_events = list(
-            filter(lambda x: x.is_alive(), self._running_events))
-        if self._running_events:
-            logging.info('Waiting for threads {}'.format(
-                self._running_events))
+        if self.virtual and not self.mqtt.remote_inputs():
+            # Nothing but the running events can plan new ones, virtual time
+            # jumps to the end, once they finish without planning any
+            self.executor.wait_idle()
+            if not self.scheduler.next_planned():
+                if self.end_time != PNSim.INF:
+                    self._clock = self.end_time
+                logging.info(f'No events left before end time {self.end_time - self.start_time}')
+                self.end_run()
+        running = self.executor.busy()
+        if running:
+            logging.info(f'Waiting for {running} running events')
         with PNSim.wake_event:
-            if self.end_time == PNSim.INF:
+            if self.scheduler.next_planned():
+                return  # Planned while the previous event was executing
+            if self.end_time == PNSim.INF or self.virtual:
                 PNSim.wake_event.wait()
             else:
                 PNSim.wake_event.wait(self.end_time - self.cur_time())
@@ -171,6 +289,8 @@ class PNSim(Thread):
         """
         Main method for net execution, will execute all transition in deterministic
         order, until none of transitions will be enabled, then finish the execution.
+        Tokens of all port messages received for the net are added to its places
+        before the execution.
 
         After finishing the execution will draw the current state into the 'current'
         directory for the selected simulation, and send all tokens from output ports.
@@ -181,12 +301,24 @@ class PNSim(Thread):
         print(f'{self.id}: Executing net {net.name}')
         logging.info(
             f'Started execution "{net}" at {self.cur_time() - self.start_time}')
-        presorted_tr = self.presort_transitions(net)
-        finished_execution = False
-        while not finished_execution:
+        delivered = self.mqtt.deliver_port_messages(net.name)
+        if delivered:
+            logging.info(f'Delivered {delivered} port messages to "{net}"')
+        presorted_tr = net.transition_groups()
+        dependents = self.dependent_transitions(net)
+        # Transitions, which could have become enabled since their last evaluation
+        dirty = set(net.transition())
+        while True:
             if self.kill:
                 sys.exit()
-            finished_execution = self.execute_groups(presorted_tr)
+            fired = self.execute_groups(presorted_tr, dirty)
+            if fired is None:
+                break
+            dirty.update(dependents[fired])
+        hits, misses = net.modes_cache_stats()
+        logging.info(f'Modes cache of "{net}": {hits} hits, {misses} misses')
+        examined, produced = net.binding_stats()
+        logging.info(f'Bindings of "{net}": {examined} candidates examined, {produced} modes produced')
         if self.debug:
             self.draw_net(net, act=True)
         net.send_tokens() # Sending tokens from output ports
@@ -211,52 +343,56 @@ class PNSim(Thread):
         except:
             pass
 
-    def execute_groups(self, groups):
+    def execute_groups(self, groups, dirty=None):
         """
-        Exectuting presorted transitions.
+        Exectuting presorted transitions. Fires the first enabled transition and
+        returns it, returns None when none of transitions is enabled.
 
         groups -- list of transitions to execute.
+        dirty --   set of transitions to evaluate, other transitions are known
+                   to be disabled and skipped. Transitions found disabled are
+                   removed from the set. All transitions are evaluated by default.
         """
-        finished_execution = True
         for group in groups:
             for t in group:
-                modes = t.modes()
-                if not modes:
+                if dirty is not None and t not in dirty:
                     continue
-                # Sorting modes to preserve the order in repeatable execution
-                modes.sort(key=lambda x: x.items())
-                finished_execution = False
-                for m in modes:
-                    if not t.enabled(m):
-                        continue
+                m = t.fire_first()
+                if m is not None:
                     print(f'Firing: <{t.name}> with {m}')
-                    t.fire(m)
                     # Should return to give chance to other transitions
                     # with new bindings to be evaluated
-                    return finished_execution
-        return finished_execution
+                    return t
+                if dirty is not None:
+                    dirty.discard(t)
+        return None
 
-    def presort_transitions(self, net):
+    def dependent_transitions(self, net):
         """
-        Sorting transitions to groups under their priority and hash.
+        Maps every transition to transitions, which should be evaluated again
+        after it fires, i.e. transitions consuming from the places it changes.
+        The map is cached until the net structure changes.
 
         net -- PetriNet instance to evaluate.
         """
-        tgroups = []
-        t_list = net.transition()
-        t_list.sort(key=lambda x: x.__hash__())
-
-        prior_tr_sort = {}
-        for t in t_list:
-            pr = t.priority() # Extracts priority from transition
-            if pr in prior_tr_sort.keys():
-                prior_tr_sort[pr].append(t)
-            else:
-                prior_tr_sort[pr] = [t]
-
-        for k in sorted(prior_tr_sort.keys()):
-            tgroups.insert(0, prior_tr_sort[k])
-        return tgroups
+        version, dependents = self._dependents.get(net.name, (None, None))
+        if version == net.structure_version:
+            return dependents
+        consumers = {}
+        for t in net.transition():
+            for place, _ in t.input():
+                consumers.setdefault(place.name, set()).add(t)
+        dependents = {}
+        for t in net.transition():
+            changed = t.input() + t.output()
+            # Probabilistic transition produces tokens through one of its neighbours
+            for nb in getattr(t.extension, 'neighbours', ()):
+                changed += nb.output()
+            dependents[t] = set()
+            for place, _ in changed:
+                dependents[t].update(consumers.get(place.name, ()))
+        self._dependents[net.name] = (net.structure_version, dependents)
+        return dependents
 
     def add_petri_net(self, net):
         """
@@ -274,6 +410,7 @@ class PNSim(Thread):
     def schedule(self, event, tm=NOW, prior=0):
         """
         Event planning on time after current running time of simulation.
+        Returns event handle, which could be passed to cancel or update_time.
 
         event --    element or list of elements, where first element
                     is a pointer to function, and others are arguments
@@ -285,26 +422,61 @@ class PNSim(Thread):
         prior --    priority of event. The elements with higher
                     priority will be sorted first.
 
+        Execution of the net, which is already planned on the same time and
+        was not started yet, is merged with the pending one.
         """
-        if self.start_time == PNSim.INF:
-            raise Exception("Simulation is not running")
         if not isinstance(event, list):
             event = [event]
+        timeval = self._planned_time(tm)
+        handle = self.scheduler.plan(
+            timeval, event, prior, self._merge_key(event, timeval))
+        self.wake()
+        return handle
+
+    def _merge_key(self, event, timeval):
+        """
+        Returns key for merging of repeated net executions planned
+        on the same time, None for any other event.
+        """
+        if len(event) == 2 and event[0] == self.execute_net:
+            return (str(event[1]), timeval)
+        return None
+
+    def _planned_time(self, tm):
+        if self.start_time == PNSim.INF:
+            raise Exception("Simulation is not running")
         if tm == PNSim.NOW: # Do at once
-            self.scheduler.plan(PNSim.NOW, event, prior)
+            return PNSim.NOW
         elif tm <= 0:
             raise ValueError('Scheduling at past')
         else:   # Wait some time
-            self.scheduler.plan(self.start_time + tm, event, prior)
+            return self.start_time + tm
+
+    def update_time(self, handle, tm=NOW, prior=None):
+        """
+        Moves the planned event on time after current running time of simulation.
+
+        handle -- event handle returned by schedule or schedule_at
+        tm --     new time value to plan event at. Default value is 'now'.
+        prior --  new priority of event, the current one is kept by default.
+        """
+        self.scheduler.reschedule(handle, self._planned_time(tm), prior)
         self.wake()
+        return handle
 
-    def update_time(self, event, tm=NOW, prior=0):
-        self.scheduler.remove_planned(PNSim.INF, event, prior)
-        self.schedule(event, tm, prior)
+    def cancel(self, handle):
+        """
+        Cancels the planned event. Returns True, when the event
+        was still waiting for execution.
+
+        handle -- event handle returned by schedule or schedule_at
+        """
+        return self.scheduler.cancel(handle)
 
     def schedule_at(self, event, tm, prior=0):
         """
         Event planning on time from beginning of simulation.
+        Returns event handle, which could be passed to cancel or update_time.
         """
         if tm <= 0 and tm != PNSim.NOW:
             raise ValueError("Scheduling at past")
@@ -312,9 +484,10 @@ class PNSim(Thread):
             event = [event]
         if not callable(event[0]):
             raise TypeError('Event should be callable')
-        self.scheduler.plan(tm, event, prior)
+        handle = self.scheduler.plan(tm, event, prior, self._merge_key(event, tm))
         if self.start_time != PNSim.INF:   # Simulation is running
             self.wake()
+        return handle
 
     def wake(self):
         with self.wake_event:
@@ -322,67 +495,440 @@ class PNSim(Thread):
         if self.kill:
             self.end_run()
 
+class Event:
+    """
+    Handle of the planned event, returned by Scheduler.plan.
+
+    Keeps the planned time, priority and executable of the event,
+    allows to cancel or reschedule it later.
+    """
+
+    def __init__(self, timeval, executable, prior=0, key=None):
+        self.time = timeval
+        self.executable = executable
+        self.prior = prior
+        self.key = key          # Events with the same key are merged while pending
+        self.seq = None         # Sequence number of the valid queue entry
+        self.cancelled = False
+
+    def __repr__(self):
+        return f'Event({self.time}, {self.executable}, prior={self.prior})'
+
+    def pending(self):
+        """
+        Returns True, when the event is still waiting for execution.
+        """
+        return self.seq is not None and not self.cancelled
+
+
 class Scheduler:
 
-    def __init__(self):
-        self.queue = []
+    def __init__(self, queue=None):
+        """
+        Planner of the simulation events.
+
+        queue -- backend keeping the running events ordered, HeapQueue by default.
+                 TimingWheel could be used for large number of timed events.
+        """
+        self.queue = queue if queue is not None else HeapQueue()
         self.preplanned = []
         self.running = False
         self.lock = RLock()
+        self.counter = count()  # Keeps insertion order for events planned at the same time
+        self.keyed = {}         # Key -> pending event planned with it
+        self.merged = 0         # Number of events merged into already pending ones
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue) + len(self.preplanned)
+
+    @property
+    def resolution(self):
+        """
+        Time granularity of the events release, in seconds.
+        """
+        return self.queue.resolution
 
     def start(self, timeval):
-        self.running = True
-        for prep in self.preplanned:
-            t, ev, pr = prep
-            if t != PNSim.NOW:
-                t += timeval
-            self.plan(t, ev, pr)
-        self.preplanned = []
+        with self.lock:
+            self.running = True
+            for event in self.preplanned:
+                if event.cancelled:
+                    continue
+                if event.time != PNSim.NOW:
+                    event.time += timeval
+                self._push(event)
+            self.preplanned = []
 
-    def plan(self, timeval, executable, prior=0):
+    def plan(self, timeval, executable, prior=0, key=None):
         """
-        Inserts new planned executable in priority heap queue with attention to
-        executable's priority.
+        Inserts new planned executable in priority queue with attention to
+        executable's priority. Returns event handle for later cancellation
+        or rescheduling.
 
-        Queue is sorted in ascending way, by priority and time.
-        Priority should be converted to negative value to preserve queue's
-        sorting direction.
+        Queue is sorted in ascending way, by time and priority.
+        Events with the same time and priority are kept in order of planning.
+
+        When key is specified and the event with the same key is still pending,
+        no new event is planned and the pending one is returned instead.
         """
         with self.lock:
+            if key is not None:
+                pending = self.keyed.get(key)
+                if pending is not None and pending.pending():
+                    self.merged += 1
+                    return pending
+            event = Event(timeval, executable, prior, key)
+            if key is not None:
+                self.keyed[key] = event
             if self.running:
-                heappush(self.queue, (timeval, -prior, executable))
+                self._push(event)
             else:
-                self.preplanned.append((timeval, executable, prior))
+                event.seq = next(self.counter)
+                self.preplanned.append(event)
+        return event
+
+    def _push(self, event):
+        event.seq = next(self.counter)
+        self.queue.push(event)
 
     def pop_planned(self):
         """
         Returns and pops next planned executable form scheduler.
-        Returns None when heap is empty
+        Returns None when queue is empty
         """
         with self.lock:
-            if self.queue:
-                timeval, _, executable = heappop(self.queue)
-                return timeval, executable
-            else:
+            timeval, event = self.queue.pop()
+            if event is None:
                 return None, None
-
+            event.seq = None
+            self._unkey(event)
+            return timeval, event.executable
 
     def next_planned(self):
         """
-        Returns next planned executable in scheduler or None when executable heap is empty
+        Returns time of next planned executable in scheduler or None when queue is empty
+        """
+        with self.lock:
+            return self.queue.peek()
+
+    def cancel(self, event):
+        """
+        Cancels planned event. Entry is left in queue and skipped
+        when it reaches the top of the queue.
+
+        Returns True, when the event was still waiting for execution.
+
+        event -- event handle returned by plan
         """
         with self.lock:
-            if self.queue:
-                return self.queue[0][0]
+            if not event.pending():
+                return False
+            event.cancelled = True
+            self._unkey(event)
+            if self.running:
+                event.seq = None
+                self.queue.discard(event)
             else:
-                return None
+                self.preplanned.remove(event)
+            return True
 
-    def remove_planned(self, timeval, executable, prior=0):
+    def reschedule(self, event, timeval, prior=None):
         """
-        Removes planned event
+        Moves planned event to another time, cancelled or already executed
+        event is planned again. Returns the event handle.
 
-        timeval -- value of time for event
-        executable -- list of function instance and it's arguments
+        event --   event handle returned by plan
+        timeval -- new value of time for event
+        prior --   new priority of event, the current one is kept by default
         """
         with self.lock:
-            self.queue.remove((timeval, prior, executable))
+            if prior is not None:
+                event.prior = prior
+            event.time = timeval
+            self._unkey(event)  # Key is bound to the original time
+            if not self.running:
+                if not event.pending():
+                    event.cancelled = False
+                    event.seq = next(self.counter)
+                    self.preplanned.append(event)
+                return event
+            if event.pending():
+                event.seq = None
+                self.queue.discard(event)
+            event.cancelled = False
+            self._push(event)
+            return event
+
+    def _unkey(self, event):
+        if event.key is not None and self.keyed.get(event.key) is event:
+            del self.keyed[event.key]
+        event.key = None
+
+
+class HeapQueue:
+    """
+    Binary heap backend of the Scheduler.
+
+    Entries of cancelled and rescheduled events are left in heap and dropped,
+    when they get to the top. The heap is rebuilt, when it consists mostly
+    of such dead entries.
+    """
+    resolution = 0.0
+
+    def __init__(self):
+        self.heap = []
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.heap) - self.dead
+
+    def push(self, event):
+        # Priority is converted to negative value to preserve heap's sorting direction
+        heappush(self.heap, (event.time, -event.prior, event.seq, event))
+
+    def discard(self, event):
+        self.dead += 1
+        if self.dead > 64 and self.dead * 2 > len(self.heap):
+            self.heap = [e for e in self.heap if e[2] == e[3].seq]
+            heapify(self.heap)
+            self.dead = 0
+
+    def peek(self):
+        self._drop_dead()
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self):
+        self._drop_dead()
+        if not self.heap:
+            return None, None
+        timeval, _, _, event = heappop(self.heap)
+        return timeval, event
+
+    def _drop_dead(self):
+        while self.heap and self.heap[0][2] != self.heap[0][3].seq:
+            heappop(self.heap)
+            self.dead -= 1
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel backend of the Scheduler.
+
+    Time is split into ticks of configured length. All events expiring
+    in the same tick are released together at the end of the tick, so they
+    are served by a single wakeup of the simulation loop.
+
+    Level 0 of the wheel holds events of the next `slots` ticks, every other
+    level covers `slots` times longer period, events beyond the last level wait
+    in overflow heap. When the wheel turns into a slot of a higher level, its
+    events are cascaded to the lower levels. Released events are kept in heap
+    ordered by tick, priority and order of planning.
+    """
+
+    def __init__(self, tick=0.1, slots=256, levels=4):
+        """
+        tick --   length of one tick in seconds
+        slots --  number of slots on every level of the wheel
+        levels -- number of wheel levels
+        """
+        if tick <= 0:
+            raise ValueError(f'Expected positive tick length, got {tick}')
+        if slots < 2 or levels < 1:
+            raise ValueError('Wheel needs at least one level with two slots')
+        self.resolution = tick
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.counts = [0] * levels  # Entries stored on every level
+        self.overflow = []          # Heap of entries beyond the last level
+        self.due = []               # Heap of released entries
+        self.cur = 0                # Tick the wheel is turned to
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def _tick(self, timeval):
+        if timeval == PNSim.NOW:
+            return -1   # Precedes any tick of the simulation time
+        return math.ceil(timeval / self.resolution)
+
+    def push(self, event):
+        self.live += 1
+        self._insert((self._tick(event.time), event.seq, event))
+
+    def discard(self, event):
+        self.live -= 1
+
+    def _insert(self, entry):
+        tick, seq, event = entry
+        if tick <= self.cur:
+            heappush(self.due, (tick, -event.prior, seq, event))
+            return
+        for level in range(self.levels):
+            block = self.spans[level + 1]
+            if tick // block == self.cur // block:
+                slot = (tick // self.spans[level]) % self.slots
+                self.wheels[level][slot].append(entry)
+                self.counts[level] += 1
+                return
+        heappush(self.overflow, entry)
+
+    def _advance(self):
+        """
+        Turns the wheel to the next non-empty slot and releases or cascades
+        its entries. Returns False, when the wheel is empty.
+        """
+        for level in range(self.levels):
+            if self.counts[level]:
+                break
+        else:
+            if not self.overflow:
+                return False
+            # Jumping to the top level block of the earliest overflowed entry
+            block = self.spans[self.levels]
+            self.cur = self.overflow[0][0] // block * block
+            while self.overflow and self.overflow[0][0] // block == self.cur // block:
+                self._cascade(heappop(self.overflow))
+            return True
+        span = self.spans[level]
+        wheel = self.wheels[level]
+        slot = (self.cur // span) % self.slots + 1
+        while not wheel[slot]:
+            slot += 1
+        entries, wheel[slot] = wheel[slot], []
+        self.counts[level] -= len(entries)
+        block = self.spans[level + 1]
+        self.cur = self.cur // block * block + slot * span
+        if level == 0 and not self.due:
+            # Whole slot expires in the current tick, released at once
+            self.due = [(tick, -event.prior, seq, event)
+                        for tick, seq, event in entries if seq == event.seq]
+            heapify(self.due)
+            return True
+        for entry in entries:
+            self._cascade(entry)
+        return True
+
+    def _cascade(self, entry):
+        if entry[1] == entry[2].seq:   # Dead entries are dropped
+            self._insert(entry)
+
+    def _head(self):
+        while True:
+            while self.due and self.due[0][2] != self.due[0][3].seq:
+                heappop(self.due)
+            if self.due or not self.live or not self._advance():
+                return self.due[0] if self.due else None
+
+    def peek(self):
+        head = self._head()
+        if head is None:
+            return None
+        return PNSim.NOW if head[0] < 0 else head[0] * self.resolution
+
+    def pop(self):
+        head = self._head()
+        if head is None:
+            return None, None
+        heappop(self.due)
+        self.live -= 1
+        tick, _, _, event = head
+        return (PNSim.NOW if tick < 0 else tick * self.resolution), event
+
+
+class Executor:
+    """
+    Fixed size pool of worker threads for the planned events.
+
+    Each event is submitted into a lane, usually named after the Petri net it
+    works with. Events of one lane are executed one by one in submission order,
+    while the lanes themselves are spread among the workers in round robin manner.
+    """
+
+    def __init__(self, workers=4):
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError(f'Expected positive number of workers, got {workers}')
+        self.size = workers
+        self.lanes = {}         # Lane -> queue of events waiting in it
+        self.ready = deque()    # Lanes with waiting events, not taken by any worker
+        self.pending = 0        # Submitted and not yet finished events
+        self.cond = Condition()
+        self.stopped = False
+        self.workers = []
+
+    def start(self):
+        with self.cond:
+            if self.workers:
+                return
+            self.stopped = False
+            for i in range(self.size):
+                worker = Thread(target=self._work, name=f'Executor-{i}', daemon=True)
+                self.workers.append(worker)
+                worker.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.workers = []
+
+    def submit(self, lane, function, args=()):
+        """
+        Queues the event into selected lane.
+
+        lane --     hashable lane identifier, None means event is not bound to any
+                    lane and may run concurrently with everything else.
+        function -- callable to execute
+        args --     arguments to pass
+        """
+        if lane is None:
+            lane = object()     # Private lane for the single event
+        with self.cond:
+            self.pending += 1
+            if lane in self.lanes:  # Lane is already waiting or running
+                self.lanes[lane].append((function, args))
+                return
+            self.lanes[lane] = deque([(function, args)])
+            self.ready.append(lane)
+            self.cond.notify_all()
+
+    def busy(self):
+        """
+        Returns number of submitted events, which are not finished yet.
+        """
+        with self.cond:
+            return self.pending
+
+    def wait_idle(self, timeout=None):
+        """
+        Blocks until all submitted events are finished.
+        Returns False when timeout has expired first.
+        """
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.pending == 0 or self.stopped, timeout)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.ready or self.stopped)
+                if self.stopped:
+                    return
+                lane = self.ready.popleft()
+                function, args = self.lanes[lane].popleft()
+            try:
+                function(*args)
+            except SystemExit:
+                pass
+            except Exception:
+                logging.exception(f'Event {function} failed')
+            with self.cond:
+                self.pending -= 1
+                if self.lanes[lane]:
+                    self.ready.append(lane)  # Going to the end of the line
+                else:
+                    del self.lanes[lane]
+                self.cond.notify_all()
@@ -0,0 +1,166 @@
+#!/bin/python3.7
+"""
+Buffers of port messages for nets, which are not registered yet.
+
+Every record holds the topic of the target port, delivery mode and tokens
+encoded in the binary token format, so it can be written to the disk and
+sent without encoding, when the target net accepts the binary format.
+
+Records over the size of the buffer are dropped or spilled to the segment
+log on the disk, depending on the policy. Segment is a file of records:
+
+    record := LENGTH TOPIC_LENGTH TOPIC DELIVERY_LENGTH DELIVERY PAYLOAD
+
+LENGTH is !I length of the rest of the record, TOPIC_LENGTH and
+DELIVERY_LENGTH are !H lengths of the following UTF-8 strings.
+"""
+
+import os
+import struct
+from threading import Lock
+from collections import deque
+
+import token_codec
+
+_length = struct.Struct('!I')
+_short = struct.Struct('!H')
+
+
+class TargetBuffer():
+    '''
+    Bounded buffer of port messages for one target net.
+
+    When the buffer is full, the policy decides what happens with the next message:
+        drop_oldest --  the oldest buffered message is dropped
+        drop_newest --  the new message is dropped
+        spill --        the new message is appended to the segment log on the disk,
+                        all following messages too, until the buffer is taken
+    '''
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    SPILL = 'spill'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, SPILL)
+
+    def __init__(self, net, size=1000, policy=DROP_OLDEST, directory='buffers',
+                 segment_size=1 << 20):
+        '''
+        net --          name of the target net
+        size --         maximum number of messages kept in memory
+        policy --       handling of messages over the size, one of POLICIES
+        directory --    directory of the segment log
+        segment_size -- size of the segment file in bytes, when it is exceeded,
+                        next records are written to a new segment
+        '''
+        if not isinstance(size, int) or size < 1:
+            raise ValueError(f'Expected positive size of buffer, got {size}')
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown buffer policy "{policy}", choose from: {", ".join(self.POLICIES)}')
+        self.net = net
+        self.size = size
+        self.policy = policy
+        self.directory = directory
+        self.segment_size = segment_size
+        self.records = deque()  # (topic, delivery, payload) kept in memory
+        self.segments = []      # Paths of the segment files in order of writing
+        self.segment_bytes = 0  # Size of the last segment
+        self.spilled = 0        # Number of records on the disk
+        self.spilled_bytes = 0
+        self.memory_bytes = 0
+        self.dropped = 0
+        self.lock = Lock()
+
+    def depth(self):
+        '''
+        Returns number of buffered messages, in memory and on the disk.
+        '''
+        return len(self.records) + self.spilled
+
+    def bytes(self):
+        '''
+        Returns size of buffered payloads in memory and size of the segment log.
+        '''
+        return self.memory_bytes + self.spilled_bytes
+
+    def append(self, topic, tokens, check=None, delivery='exactly_once'):
+        '''
+        Buffers the tokens for the port.
+
+        topic --    topic of the target port
+        tokens --   list of tokens to send
+        check --    type of the sending place, selects the binary codec
+        delivery -- delivery mode of the port
+        '''
+        payload = token_codec.encode(tokens, check, token_codec.BINARY)
+        with self.lock:
+            if self.spilled:    # Keeps order of the records, once spilling started
+                self._spill(topic, delivery, payload)
+                return
+            if len(self.records) >= self.size:
+                if self.policy == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.policy == self.SPILL:
+                    self._spill(topic, delivery, payload)
+                    return
+                _, _, oldest = self.records.popleft()
+                self.memory_bytes -= len(oldest)
+                self.dropped += 1
+            self.records.append((topic, delivery, payload))
+            self.memory_bytes += len(payload)
+
+    def take(self):
+        '''
+        Removes and returns all buffered messages as list of (topic, delivery, payload)
+        in order of buffering, the segment log is read in bulk and deleted.
+        '''
+        with self.lock:
+            records = list(self.records)
+            self.records.clear()
+            self.memory_bytes = 0
+            for path in self.segments:
+                with open(path, 'rb') as segment:
+                    records.extend(self._read_segment(segment.read()))
+                os.remove(path)
+            self.segments = []
+            self.segment_bytes = self.spilled = self.spilled_bytes = 0
+        return records
+
+    def _spill(self, topic, delivery, payload):
+        topic = topic.encode('utf-8')
+        delivery = delivery.encode('utf-8')
+        body = b''.join((
+            _short.pack(len(topic)), topic, _short.pack(len(delivery)), delivery, payload))
+        record = _length.pack(len(body)) + body
+        if not self.segments or self.segment_bytes + len(record) > self.segment_size:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{self.net}-{len(self.segments)}.seg')
+            open(path, 'wb').close()
+            self.segments.append(path)
+            self.segment_bytes = 0
+        with open(self.segments[-1], 'ab') as segment:
+            segment.write(record)
+        self.segment_bytes += len(record)
+        self.spilled += 1
+        self.spilled_bytes += len(record)
+
+    @staticmethod
+    def _read_segment(data):
+        records = []
+        offset = 0
+        while offset + _length.size <= len(data):
+            length, = _length.unpack_from(data, offset)
+            offset += _length.size
+            end = offset + length
+            if end > len(data):
+                break   # Record was not written completely
+            size, = _short.unpack_from(data, offset)
+            offset += _short.size
+            topic = data[offset:offset + size].decode('utf-8')
+            offset += size
+            size, = _short.unpack_from(data, offset)
+            offset += _short.size
+            delivery = data[offset:offset + size].decode('utf-8')
+            offset += size
+            records.append((topic, delivery, data[offset:end]))
+            offset = end
+        return records
@@ -28,10 +28,12 @@ def add_net(net, sim):
     sim.schedule_at([sim.execute_net, net.name], PNSim.NOW)
 
 
-def execute_nets(net_list, broker="127.0.0.1", sim_id=None, detached=True, debug=True):
+def execute_nets(net_list, broker="127.0.0.1", sim_id=None, detached=True, debug=True,
+                 virtual=False, end_time=PNSim.INF, timer_tick=None):
     signal.signal(signal.SIGTERM, terminate)
     signal.signal(signal.SIGINT, terminate)
-    sim = PNSim(broker=broker, simul_id=sim_id, detached=detached, debug=debug)
+    sim = PNSim(broker=broker, simul_id=sim_id, detached=detached, debug=debug,
+                virtual=virtual, timer_tick=timer_tick)
     if isinstance(net_list, list):
         for net in net_list:
             add_net(net, sim)
@@ -39,7 +41,7 @@ def execute_nets(net_list, broker="127.0.0.1", sim_id=None, detached=True, debug
         net = net_list
         add_net(net, sim)
 
-    sim.setup()
+    sim.setup(end_time)
     try:
         sim.start()
         sim.join()
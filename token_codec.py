@@ -0,0 +1,288 @@
+#!/bin/python3.7
+"""
+Wire formats of tokens sent between nets over MQTT.
+
+Two formats are supported:
+    text -- tokens as "<type name>:<value>" joined by '&', tuples are
+            encoded as a list of their encoded items, e.g.
+            "float:21.5&tuple:['str:kitchen', 'bool:True']"
+    bin1 -- versioned binary format, scalars are packed by struct,
+            strings and tuples are length-prefixed
+
+Binary payload starts with a zero byte, which never starts a text payload,
+followed by version, codec and count of tokens:
+
+    payload := 0x00 VERSION CODEC COUNT body
+
+COUNT is a single byte for less than 255 tokens, byte 255 followed by !I
+otherwise.
+
+The codec is chosen by the check= type of the sending place:
+    d -- tFloat, body is an array of !d
+    q -- tInteger, body is an array of !q
+    ? -- tBoolean, body is an array of !?
+    s -- tString, body is a sequence of !I length and UTF-8 bytes
+    . -- tBlackToken, body is empty
+    g -- any other type, body is a sequence of tagged values
+
+Tagged value is a tag byte followed by the value: n None, . dot,
+? bool, q int, Q long int (!I length and signed bytes), d float,
+s string, b bytes and ( tuple (!I count and tagged items).
+"""
+
+import ast
+import struct
+from snakes.nets import dot, BlackToken, tFloat, tInteger, tBoolean, tString, tBlackToken
+
+TEXT = 'text'
+BINARY = 'bin1'
+FORMATS = (BINARY, TEXT)    # Supported formats in order of preference
+
+MAGIC = b'\x00'
+VERSION = 1
+_HEADER = MAGIC + bytes((VERSION,))
+
+GENERIC = b'g'
+PLACE_CODECS = {
+    tFloat: b'd',
+    tInteger: b'q',
+    tBoolean: b'?',
+    tString: b's',
+    tBlackToken: b'.',
+}
+
+_count = struct.Struct('!I')
+_int = struct.Struct('!q')
+_float = struct.Struct('!d')
+_arrays = {}    # Structs of arrays of scalars by codec and count
+
+
+def _array(codec, count):
+    array = _arrays.get((codec, count))
+    if array is None:
+        array = struct.Struct(f'!{count}{codec.decode()}')
+        if len(_arrays) < 1024:
+            _arrays[codec, count] = array
+    return array
+
+
+def negotiate(formats):
+    """
+    Returns the preferred format of the supported ones, text when there is none.
+
+    formats -- formats supported by the other side
+    """
+    for fmt in FORMATS:
+        if fmt in formats:
+            return fmt
+    return TEXT
+
+
+def encode(tokens, check=None, fmt=BINARY):
+    """
+    Encodes tokens to the payload of a message.
+
+    tokens -- collection of tokens to encode
+    check --  type of the place holding the tokens, selects the binary codec
+    fmt --    format of the payload, tokens of types unsupported
+              by the binary format are sent as text
+    """
+    tokens = list(tokens)
+    if fmt == BINARY:
+        try:
+            return encode_binary(tokens, check)
+        except TypeError:
+            pass
+    elif fmt != TEXT:
+        raise ValueError(f'Unknown token format "{fmt}"')
+    return encode_text(tokens).encode('utf-8')
+
+
+def decode(payload):
+    """
+    Decodes the payload of a message in any of the formats to a list of tokens.
+    """
+    if payload[:1] == MAGIC:
+        return decode_binary(payload)
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    return decode_text(payload)
+
+
+def encode_text(tokens):
+    return '&'.join(_text_items(tokens))
+
+
+def _text_items(tokens):
+    result = []
+    for token in tokens:
+        if isinstance(token, (tuple, list, set)):
+            result.append(
+                f'{token.__class__.__name__}:{_text_items(token)}')
+        else:
+            result.append(f'{token.__class__.__name__}:{token}')
+    return result
+
+
+def decode_text(payload):
+    if not payload:
+        return []
+    return [_text_token(item) for item in payload.split('&')]
+
+
+def _text_token(item):
+    tp, value = item.split(':', 1)
+    if tp == 'tuple':
+        return tuple(_text_token(v) for v in ast.literal_eval(value))
+    elif tp == 'bool':
+        return value == 'True'
+    elif tp == 'BlackToken':
+        return dot
+    elif tp in ('int', 'float', 'str'):
+        return {'int': int, 'float': float, 'str': str}[tp](value)
+    raise ValueError(f'Unsupported token type "{tp}" in text payload')
+
+
+def place_codec(check):
+    """
+    Returns the binary codec for tokens of the place type.
+    """
+    for tp, codec in PLACE_CODECS.items():
+        if check is tp:
+            return codec
+    try:
+        return PLACE_CODECS.get(check, GENERIC)
+    except TypeError:   # Unhashable type
+        return GENERIC
+
+
+def encode_binary(tokens, check=None):
+    """
+    Encodes tokens to binary payload, raises TypeError for tokens of
+    unsupported types.
+    """
+    codec = place_codec(check)
+    count = len(tokens)
+    # Tokens are verified as the place type may accept other types too,
+    # e.g. tBoolean accepts 1 and tInteger accepts True
+    if codec == b'd' and all(type(t) is float for t in tokens):
+        body = _array(codec, count).pack(*tokens)
+    elif codec == b'q' and all(type(t) is int and -2**63 <= t < 2**63 for t in tokens):
+        body = _array(codec, count).pack(*tokens)
+    elif codec == b'?' and all(type(t) is bool for t in tokens):
+        body = _array(codec, count).pack(*tokens)
+    elif codec == b's' and all(type(t) is str for t in tokens):
+        parts = []
+        for t in tokens:
+            data = t.encode('utf-8')
+            parts.append(_count.pack(len(data)))
+            parts.append(data)
+        body = b''.join(parts)
+    elif codec == b'.' and all(isinstance(t, BlackToken) for t in tokens):
+        body = b''
+    else:
+        codec = GENERIC
+        parts = []
+        for t in tokens:
+            _encode_value(t, parts)
+        body = b''.join(parts)
+    if count < 255:
+        return _HEADER + codec + bytes((count,)) + body
+    return _HEADER + codec + b'\xff' + _count.pack(count) + body
+
+
+def _encode_value(value, parts):
+    tp = type(value)
+    if value is None:
+        parts.append(b'n')
+    elif isinstance(value, BlackToken):
+        parts.append(b'.')
+    elif tp is bool:
+        parts.append(b'?\x01' if value else b'?\x00')
+    elif tp is int:
+        if -2**63 <= value < 2**63:
+            parts.append(b'q' + _int.pack(value))
+        else:
+            data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+            parts.append(b'Q' + _count.pack(len(data)) + data)
+    elif tp is float:
+        parts.append(b'd' + _float.pack(value))
+    elif tp is str:
+        data = value.encode('utf-8')
+        parts.append(b's' + _count.pack(len(data)) + data)
+    elif tp is bytes:
+        parts.append(b'b' + _count.pack(len(value)) + value)
+    elif tp is tuple:
+        parts.append(b'(' + _count.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    else:
+        raise TypeError(f'Token type {tp.__name__} is not supported by binary format')
+
+
+def decode_binary(payload):
+    if len(payload) < 4 or payload[:1] != MAGIC:
+        raise ValueError('Not a binary token payload')
+    version = payload[1]
+    if version > VERSION:
+        raise ValueError(f'Unsupported binary token format version {version}')
+    codec = payload[2:3]
+    count = payload[3]
+    offset = 4
+    if count == 255:
+        count, = _count.unpack_from(payload, offset)
+        offset += 4
+    if codec in (b'd', b'q', b'?'):
+        return list(_array(codec, count).unpack_from(payload, offset))
+    elif codec == b's':
+        tokens = []
+        for _ in range(count):
+            size, = _count.unpack_from(payload, offset)
+            offset += 4
+            tokens.append(payload[offset:offset + size].decode('utf-8'))
+            offset += size
+        return tokens
+    elif codec == b'.':
+        return [dot] * count
+    elif codec == GENERIC:
+        tokens = []
+        for _ in range(count):
+            token, offset = _decode_value(payload, offset)
+            tokens.append(token)
+        return tokens
+    raise ValueError(f'Unknown binary token codec {codec}')
+
+
+def _decode_value(payload, offset):
+    tag = payload[offset:offset + 1]
+    offset += 1
+    if tag == b'n':
+        return None, offset
+    elif tag == b'.':
+        return dot, offset
+    elif tag == b'?':
+        return payload[offset] != 0, offset + 1
+    elif tag == b'q':
+        return _int.unpack_from(payload, offset)[0], offset + 8
+    elif tag == b'd':
+        return _float.unpack_from(payload, offset)[0], offset + 8
+    elif tag in (b'Q', b's', b'b'):
+        size, = _count.unpack_from(payload, offset)
+        offset += 4
+        data = payload[offset:offset + size]
+        if tag == b'Q':
+            value = int.from_bytes(data, 'big', signed=True)
+        elif tag == b's':
+            value = data.decode('utf-8')
+        else:
+            value = bytes(data)
+        return value, offset + size
+    elif tag == b'(':
+        size, = _count.unpack_from(payload, offset)
+        offset += 4
+        items = []
+        for _ in range(size):
+            item, offset = _decode_value(payload, offset)
+            items.append(item)
+        return tuple(items), offset
+    raise ValueError(f'Unknown binary token tag {tag}')
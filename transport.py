@@ -0,0 +1,541 @@
+#!/bin/python3.7
+"""
+Transports of messages between simulators.
+
+Usage:
+    transport.py PATH
+
+Serves the bus over Unix domain socket PATH, until it is interrupted.
+
+Mqtt_client uses clients of the transports through the subset
+of the interface of paho.mqtt.client.Client:
+
+    on_message --   callback(client, userdata, message) of received messages
+    on_connect --   callback(client, userdata, flags, rc) of every established
+                    connection, also after reconnection
+    on_disconnect -- callback(client, userdata, rc) of the lost connection
+    on_publish --   callback(client, userdata, mid) of the message accepted
+                    by the broker
+    user_data_set(userdata)
+    will_set(topic, payload, qos, retain)
+    reconnect_delay_set(min_delay, max_delay)
+    connect(address), disconnect()
+    loop_start(), loop_stop()
+    subscribe(topic, qos), unsubscribe(topic)
+    publish(topic, payload, qos, retain) -- returns info with mid and rc
+
+The transport is selected by the scheme of the broker address:
+    mqtt://HOST[:PORT] -- MQTT broker through paho, address without
+                          scheme is the host of the MQTT broker
+    local://NAME --       in-process bus shared by simulators of one interpreter
+    unix://PATH --        bus served over Unix domain socket, for simulators
+                          on one host
+
+Local and Unix socket transports deliver messages in order of publishing
+and exactly once while the client is connected, QoS is kept only for
+the interface. Topic filters with + and #, retained messages and last will
+behave as in MQTT, the will is published, when the socket is closed
+without disconnect. Lost connection to the Unix socket is opened again
+with exponential backoff between the attempts, as paho does, messages
+are not sent again by the client though.
+
+Unix socket carries frames in both directions:
+
+    frame := LENGTH TYPE QOS RETAIN TOPIC_LENGTH TOPIC PAYLOAD
+
+LENGTH is !I length of the rest of the frame, TOPIC_LENGTH is !H length
+of the UTF-8 topic. TYPE is C connect with the last will in topic and payload,
+S subscribe, U unsubscribe, P publish, D disconnect, M message delivered
+to the client and A acknowledgement of the published message with QoS > 0.
+Acknowledgements come in order of publishing.
+"""
+
+import os
+import sys
+import stat
+import struct
+import socket
+from queue import SimpleQueue
+from collections import deque
+from itertools import count
+from threading import Lock, Thread, Event, current_thread
+import paho.mqtt.client as mqtt
+
+MQTT = 'mqtt'
+LOCAL = 'local'
+UNIX = 'unix'
+
+_header = struct.Struct('!IcBBH')
+_buses = {}     # In-process buses by name
+_buses_lock = Lock()
+
+
+def create_client(address):
+    """
+    Returns new client of the transport selected by the broker address
+    and tuple of arguments of its connect.
+    """
+    scheme, separator, location = address.partition('://')
+    if not separator:
+        return mqtt.Client(), (address,)
+    if scheme == MQTT:
+        host, _, port = location.partition(':')
+        return mqtt.Client(), (host, int(port or 1883))
+    elif scheme == LOCAL:
+        return LocalClient(), (location,)
+    elif scheme == UNIX:
+        return SocketClient(), (location,)
+    raise ValueError(f'Unknown transport "{scheme}" of broker address {address}, '
+                     f'choose from: {", ".join((MQTT, LOCAL, UNIX))}')
+
+
+def resends(client):
+    """
+    Returns True, when the client sends unacknowledged messages with QoS > 0
+    again after reconnection by itself, as paho does.
+    """
+    return isinstance(client, mqtt.Client)
+
+
+def durable(client):
+    """
+    Returns True, when messages accepted by the broker of the client outlive
+    the simulator, so they are worth keeping in the journal. Messages
+    of the in-process bus are lost together with the simulator.
+    """
+    return not isinstance(client, LocalClient)
+
+
+def local_bus(name):
+    """
+    Returns the in-process bus of the name, it is created by the first client.
+    """
+    with _buses_lock:
+        return _buses.setdefault(name, Bus())
+
+
+class Message():
+    '''
+    Received message, attributes match paho.mqtt.client.MQTTMessage.
+    '''
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MessageInfo():
+    '''
+    Result of publish, attributes match paho.mqtt.client.MQTTMessageInfo.
+    '''
+
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+
+class Bus():
+    '''
+    Routes published messages to the clients by their topic filters
+    and keeps retained messages.
+
+    Client of the bus is any object with method deliver(message).
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.filters = {}   # Client -> {topic filter: qos}
+        self.routes = {}    # Topic -> subscribed clients, cleared on change of subscriptions
+        self.retained = {}  # Topic -> payload of the retained message
+
+    def subscribe(self, client, topic, qos=0):
+        '''
+        Adds the topic filter of the client, retained messages matching
+        the filter are delivered to the client right away.
+        '''
+        with self.lock:
+            self.filters.setdefault(client, {})[topic] = qos
+            self.routes.clear()
+            retained = [Message(name, payload, qos, True)
+                        for name, payload in self.retained.items()
+                        if mqtt.topic_matches_sub(topic, name)]
+        for message in retained:
+            client.deliver(message)
+
+    def unsubscribe(self, client, topic):
+        with self.lock:
+            self.filters.get(client, {}).pop(topic, None)
+            self.routes.clear()
+
+    def detach(self, client):
+        '''
+        Removes all topic filters of the client.
+        '''
+        with self.lock:
+            self.filters.pop(client, None)
+            self.routes.clear()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        '''
+        Delivers the message to every client with a matching topic filter.
+        Retained message replaces the previous one of the topic, empty
+        retained message removes it.
+        '''
+        with self.lock:
+            if retain and payload:
+                self.retained[topic] = payload
+            elif retain:
+                self.retained.pop(topic, None)
+            clients = self.routes.get(topic)
+            if clients is None:
+                clients = [client for client, filters in self.filters.items()
+                           if any(mqtt.topic_matches_sub(f, topic) for f in filters)]
+                if len(self.routes) < 10000:
+                    self.routes[topic] = clients
+        message = Message(topic, payload, qos)
+        for client in clients:
+            client.deliver(message)
+
+
+def _payload(payload):
+    if payload is None:
+        return b''
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('utf-8')
+    return bytes(payload)
+
+
+def _frame(kind, topic, payload=b'', qos=0, retain=False):
+    topic = topic.encode('utf-8')
+    return _header.pack(
+        _header.size - 4 + len(topic) + len(payload), kind, qos, retain, len(topic)) + topic + payload
+
+
+def _read_frames(stream):
+    '''
+    Yields (type, topic, payload, qos, retain) of frames read from the stream,
+    until it is closed or reset.
+    '''
+    while True:
+        try:
+            header = stream.read(_header.size)
+            length, kind, qos, retain, size = _header.unpack(header)
+            body = stream.read(length + 4 - _header.size)
+        except (OSError, struct.error):
+            return  # Connection was closed, possibly within the frame
+        if len(body) < length + 4 - _header.size:
+            return
+        yield kind, body[:size].decode('utf-8'), body[size:], qos, bool(retain)
+
+
+class BusClient():
+    '''
+    Common part of the clients of the local and Unix socket transports.
+    Received messages are passed to on_message by the thread of the client,
+    started by loop_start, as paho does.
+    '''
+
+    def __init__(self):
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self._client_id = f'{self.__class__.__name__}-{id(self):x}'
+        self.userdata = None
+        self.will = None
+        self.thread = None
+        self.mids = count(1)
+        self.min_delay = 1.0
+        self.max_delay = 120.0
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, _payload(payload), qos, retain)
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        '''
+        Sets the delay before the first attempt to reconnect, it is doubled
+        after every failed attempt up to max_delay.
+        '''
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def connected(self):
+        if self.on_connect:
+            self.on_connect(self, self.userdata, {}, 0)
+
+    def published(self, mid):
+        if self.on_publish:
+            self.on_publish(self, self.userdata, mid)
+
+    def loop_start(self):
+        self.thread = Thread(target=self.loop_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, message):
+        if self.on_message:
+            self.on_message(self, self.userdata, message)
+
+    def unsubscribe(self, topic):
+        for t in [topic] if isinstance(topic, str) else topic:
+            self._unsubscribe(t)
+
+
+class LocalClient(BusClient):
+    '''
+    Client of the in-process bus.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.bus = None
+        self.inbox = SimpleQueue()
+
+    def connect(self, name):
+        self.bus = local_bus(name)
+
+    def disconnect(self):
+        self.bus.detach(self)
+
+    def deliver(self, message):
+        self.inbox.put(message)
+
+    def loop_forever(self):
+        self.connected()
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            self.handle(message)
+
+    def loop_stop(self):
+        if self.thread is None:
+            return
+        self.inbox.put(None)
+        if current_thread() is not self.thread:
+            self.thread.join()
+        self.thread = None
+
+    def subscribe(self, topic, qos=0):
+        self.bus.subscribe(self, topic, qos)
+
+    def _unsubscribe(self, topic):
+        self.bus.unsubscribe(self, topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = next(self.mids)
+        self.bus.publish(topic, _payload(payload), qos, retain)
+        self.published(mid)
+        return MessageInfo(mid)
+
+
+class SocketClient(BusClient):
+    '''
+    Client of the bus served by SocketBroker over Unix domain socket.
+    Frames are dropped, while the connection is lost.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.path = None
+        self.sock = None
+        self.lock = Lock()
+        self.inflight = deque()     # Message IDs waiting for acknowledgement
+        self.stopped = Event()
+
+    def connect(self, path):
+        self.path = path
+        self.stopped.clear()
+        self._open()
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            topic, payload, qos, retain = self.will or ('', b'', 0, False)
+            sock.sendall(_frame(b'C', topic, payload, qos, retain))
+        except OSError:
+            sock.close()
+            raise
+        with self.lock:
+            self.sock = sock
+            self.inflight.clear()   # Acknowledgements of the lost connection never come
+
+    def disconnect(self):
+        self.stopped.set()
+        self._send(b'D', '')
+
+    def _send(self, kind, topic, payload=b'', qos=0, retain=False, mid=None):
+        '''
+        Returns False, when the frame was not sent, as the connection is lost.
+        '''
+        frame = _frame(kind, topic, payload, qos, retain)
+        with self.lock:
+            if mid is not None:
+                self.inflight.append(mid)   # Acknowledgement may come before sendall returns
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                if mid is not None:
+                    self.inflight.pop()
+                return False
+        return True
+
+    def loop_forever(self):
+        while True:
+            self.connected()
+            with self.sock.makefile('rb') as stream:
+                for kind, topic, payload, qos, retain in _read_frames(stream):
+                    if kind == b'M':
+                        self.handle(Message(topic, payload, qos, retain))
+                    elif kind == b'A' and self.inflight:
+                        self.published(self.inflight.popleft())
+            if self.stopped.is_set() or not self.reconnect():
+                return
+
+    def reconnect(self):
+        '''
+        Opens the lost connection again with exponential backoff.
+        Returns False, when the client was stopped meanwhile.
+        '''
+        if self.on_disconnect:
+            self.on_disconnect(self, self.userdata, 1)
+        self.sock.close()
+        delay = self.min_delay
+        while not self.stopped.wait(delay):
+            try:
+                self._open()
+                return True
+            except OSError:
+                delay = min(delay * 2, self.max_delay)
+        return False
+
+    def loop_stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        if current_thread() is not self.thread:
+            self.thread.join()
+            self.sock.close()
+        self.thread = None
+
+    def subscribe(self, topic, qos=0):
+        self._send(b'S', topic, b'', qos)
+
+    def _unsubscribe(self, topic):
+        self._send(b'U', topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = next(self.mids)
+        if not self._send(b'P', topic, _payload(payload), qos, retain, mid if qos else None):
+            return MessageInfo(mid, mqtt.MQTT_ERR_NO_CONN)
+        if not qos:
+            self.published(mid)
+        return MessageInfo(mid)
+
+
+class _Connection():
+    '''
+    Client of the bus, which forwards messages to the socket of the connection.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = Lock()
+
+    def deliver(self, message):
+        self.send(_frame(b'M', message.topic, message.payload, message.qos, message.retain))
+
+    def send(self, frame):
+        try:
+            with self.lock:
+                self.sock.sendall(frame)
+        except OSError:
+            pass    # Connection is closed, it is detached by its thread
+
+
+class SocketBroker():
+    '''
+    Serves the bus over Unix domain socket, every connection
+    is served by its own thread.
+    '''
+
+    def __init__(self, path):
+        '''
+        path -- path of the socket, existing socket is replaced
+        '''
+        self.path = path
+        self.bus = Bus()
+        self.server = None
+        self.thread = None
+
+    def listen(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(128)
+
+    def start(self):
+        '''
+        Starts serving in the background thread.
+        '''
+        self.listen()
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return  # Server was stopped
+            Thread(target=self.serve_connection, args=(sock,), daemon=True).start()
+
+    def serve_connection(self, sock):
+        connection = _Connection(sock)
+        will = None
+        with sock, sock.makefile('rb') as stream:
+            for kind, topic, payload, qos, retain in _read_frames(stream):
+                if kind == b'P':
+                    self.bus.publish(topic, payload, qos, retain)
+                    if qos:
+                        connection.send(_frame(b'A', ''))
+                elif kind == b'S':
+                    self.bus.subscribe(connection, topic, qos)
+                elif kind == b'U':
+                    self.bus.unsubscribe(connection, topic)
+                elif kind == b'C':
+                    will = (topic, payload, qos, retain) if topic else None
+                elif kind == b'D':
+                    will = None
+                    break
+            self.bus.detach(connection)
+        if will:
+            self.bus.publish(*will)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit('Usage: transport.py PATH')
+    broker = SocketBroker(sys.argv[1])
+    broker.listen()
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        broker.stop()